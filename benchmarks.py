@@ -0,0 +1,405 @@
+'''
+Benchmarks of the grid lookup, selection, statistics and rendering hot paths.
+
+Runs each benchmark on a synthetic dataset of configurable size, records
+wall time and peak memory, and flags regressions against saved results:
+
+    python benchmarks.py --nlat 400 --nlon 600 --ntime 1460 --dask --save base.json
+    python benchmarks.py --nlat 400 --nlon 600 --ntime 1460 --dask --compare base.json
+
+The comparison is refused if the baseline was run on a different dataset.
+Slow reference implementations (legacy_benchmarks) only run when named:
+
+    python benchmarks.py --only in_circle in_circle_geopandas
+
+With --imports, also checks the cold import time of each module against
+its budget, and that no module loads the heavy map backends at import:
+
+    python benchmarks.py --imports --only
+'''
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+
+def synthetic_dataset(nlat=200,nlon=300,ntime=240,chunks=None,seed=0):
+    '''
+    Synthetic 6-hourly precipitation and return period dataset.
+
+            Parameters:
+                    nlat, nlon (int): Grid size
+                    ntime (int): Number of time steps
+                    chunks (dict): dask chunks, in-memory data if None
+                    seed (int): Random seed
+
+            Returns:
+                    ds (xarray.Dataset): prec (mm/6h) and return_period (years)
+    '''
+    rng = np.random.default_rng(seed)
+
+    lat = np.linspace(36.,44.,nlat)
+    lon = np.linspace(-9.,3.,nlon)
+    time = pd.date_range('2000-01-01',periods=ntime,freq='6h')
+
+    shape = (ntime,nlat,nlon)
+    prec = rng.gamma(0.3,4.,size=shape).astype(np.float32)
+    rp = (1 + rng.exponential(3.,size=shape)).astype(np.float32)
+
+    dims = ('time','latitude','longitude')
+    ds = xr.Dataset({'prec' : (dims,prec,{'long_name' : 'Precipitation','units' : 'mm/6h'}),
+                     'return_period' : (dims,rp,{'long_name' : 'Return period','units' : 'years'})},
+                    coords={'time' : time,'latitude' : lat,'longitude' : lon})
+
+    if chunks is not None:
+        ds = ds.chunk(chunks)
+
+    return ds
+
+
+
+def measure(func,repeat=3):
+    '''
+    Best wall time (s) of func() over repeat runs, and peak of
+    traced memory (bytes) in a separate run, as tracing slows it down.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter()-start)
+
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {'time' : min(times),'peak_memory' : peak}
+
+
+
+#############################
+# Benchmark cases
+#############################
+
+def _center(ds):
+    return {'lat' : float(ds['latitude'].mean()),'lon' : float(ds['longitude'].mean())}
+
+
+
+def bench_closest_gridpoint_indexes(ds,npoints=1000):
+    import grids
+
+    rng = np.random.default_rng(1)
+    lat = rng.uniform(float(ds['latitude'].min()),float(ds['latitude'].max()),npoints)
+    lon = rng.uniform(float(ds['longitude'].min()),float(ds['longitude'].max()),npoints)
+
+    # Includes building the grid index
+    def run():
+        grids._grid_index_cache.clear()
+        grids.closest_gridpoint_indexes(lat,lon,ds)
+
+    return run
+
+
+
+def bench_in_circle(ds):
+    import grids
+
+    return lambda: grids.in_circle(ds['prec'],_center(ds),radius=0.2,mode='points').values
+
+
+
+def bench_in_circle_geopandas(ds):
+    import grids
+
+    return lambda: grids.in_circle(ds['prec'],_center(ds),radius=0.2)
+
+
+
+def bench_min_max_xarray(ds):
+    import stats
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            stats.min_max_xarray(ds['prec'])
+
+    return run
+
+
+
+def bench_plot_prec(ds):
+    import matplotlib.pyplot as plt
+    import maps
+
+    T = ds['time'][len(ds['time'])//2]
+
+    def run():
+        fig = maps.plot_prec(ds['prec'],T,_center(ds),ds_name='synthetic')
+        fig.savefig(io.BytesIO(),format='png')
+        plt.close(fig)
+
+    return run
+
+
+
+def bench_prec_rp_spaghetti_plot(ds):
+    import matplotlib.pyplot as plt
+    import grids
+    import plots
+
+    center = _center(ds)
+    points = grids.in_circle(ds['prec'].isel(time=0),center,radius=0.2,mode='points')
+    poi = pd.DataFrame({'latitude' : points['latitude'].values,
+                        'longitude' : points['longitude'].values})
+
+    def run():
+        fig = plots.prec_rp_spaghetti_plot(ds['prec'],ds['return_period'],poi,center,
+                                           ds['time'].values[0],ds_name='synthetic')
+        fig.savefig(io.BytesIO(),format='png')
+        plt.close(fig)
+
+    return run
+
+
+
+benchmarks = {'closest_gridpoint_indexes' : bench_closest_gridpoint_indexes,
+              'in_circle' : bench_in_circle,
+              'in_circle_geopandas' : bench_in_circle_geopandas,
+              'min_max_xarray' : bench_min_max_xarray,
+              'plot_prec' : bench_plot_prec,
+              'prec_rp_spaghetti_plot' : bench_prec_rp_spaghetti_plot,
+              }
+
+# Slow reference implementations, only run when named in --only
+legacy_benchmarks = ('in_circle_geopandas',)
+
+# Arguments that must match for results to be comparable
+comparable_config = ('nlat','nlon','ntime','dask','time_chunk')
+
+
+
+#############################
+# Import time
+#############################
+
+# Cold import time budget (s) of each module
+import_budgets = {'profiling' : 0.1,
+                  'cache' : 1.5,
+                  'grids' : 1.5,
+                  'stats' : 1.5,
+                  'stations' : 1.5,
+                  'extremes' : 2.0,
+                  'regrid' : 2.0,
+                  'tiles' : 2.0,
+                  'events' : 2.5,
+                  'zonal' : 2.5,
+                  'plots' : 2.5,
+                  'maps' : 3.0,
+                  'predictors_maps' : 3.0,
+                  }
+
+# Packages that must only be imported when a function needs them
+deferred_imports = ('cartopy','plotly','geopandas')
+
+
+
+def import_time(module,repeat=3):
+    '''
+    Best cold import time (s) of a module over repeat fresh interpreters,
+    and the top-level packages it imports, from python -X importtime.
+    '''
+    env = dict(os.environ,MPLBACKEND='Agg')
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    best, packages = None, set()
+    for _ in range(repeat):
+        stderr = subprocess.run([sys.executable,'-X','importtime','-c',f'import {module}'],
+                                capture_output=True,text=True,check=True,env=env,cwd=cwd).stderr
+
+        # Lines are 'import time: self [us] | cumulative [us] | package'
+        cumulative = None
+        for line in stderr.splitlines():
+            parts = line.split('|')
+            if not line.startswith('import time:') or len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name = parts[2].strip()
+            packages.add(name.split('.')[0])
+            if name == module:
+                cumulative = int(parts[1])/1e6
+
+        if cumulative is not None and (best is None or cumulative < best):
+            best = cumulative
+
+    return {'time' : best,'packages' : sorted(packages)}
+
+
+
+def check_imports(modules=None,repeat=3):
+    '''
+    Returns the modules whose cold import time exceeds their budget
+    or that import one of deferred_imports.
+    '''
+    violations = []
+
+    for module in modules or import_budgets:
+        result = import_time(module,repeat=repeat)
+        budget = import_budgets[module]
+        loaded = [p for p in deferred_imports if p in result['packages']]
+        print(f"import {module:<22} {result['time']:10.4f} s (budget {budget} s)")
+
+        if result['time'] > budget:
+            violations.append(f"import {module}: {result['time']:.3f} s > {budget} s")
+        if loaded:
+            violations.append(f"import {module}: loads {', '.join(loaded)}")
+
+    return violations
+
+
+
+#############################
+# Running and comparing
+#############################
+
+def git_commit():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],
+                              capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return ''
+
+
+
+def run_benchmarks(ds,names=None,repeat=3):
+    '''
+    Run the benchmarks (all but legacy_benchmarks if names is None) on a dataset.
+    '''
+    results = {}
+
+    for name in names or [n for n in benchmarks if n not in legacy_benchmarks]:
+        func = benchmarks[name](ds)
+        results[name] = measure(func,repeat=repeat)
+        print(f"{name:<28} {results[name]['time']:10.4f} s {results[name]['peak_memory']/2**20:10.1f} MiB")
+
+    return results
+
+
+
+def compare(results,baseline,tolerance=0.25):
+    '''
+    Returns the benchmarks whose time or peak memory grew
+    by more than tolerance with respect to the baseline.
+    '''
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('time','peak_memory'):
+            old, new = baseline[name][metric], result[metric]
+            if old > 0 and new > old*(1+tolerance):
+                regressions.append(f'{name} {metric}: {old:.4g} -> {new:.4g} (+{(new/old-1)*100:.0f}%)')
+
+    return regressions
+
+
+
+def config_mismatches(config,baseline_config):
+    '''
+    Returns the comparable_config arguments that differ from the baseline ones
+    (time_chunk only matters with dask).
+    '''
+    mismatches = []
+
+    for key in comparable_config:
+        if key == 'time_chunk' and not config.get('dask'):
+            continue
+        if config.get(key) != baseline_config.get(key):
+            mismatches.append(f'{key}: {baseline_config.get(key)} in baseline, {config.get(key)} now')
+
+    return mismatches
+
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nlat',type=int,default=200)
+    parser.add_argument('--nlon',type=int,default=300)
+    parser.add_argument('--ntime',type=int,default=240)
+    parser.add_argument('--dask',action='store_true',help='dask-backed data, chunked along time')
+    parser.add_argument('--time-chunk',type=int,default=120)
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--only',nargs='*',choices=list(benchmarks),
+                        help='benchmarks to run (none with an empty list), '
+                             'the only way to run the legacy ones')
+    parser.add_argument('--save',help='write results to this JSON file')
+    parser.add_argument('--compare',help='JSON file of baseline results')
+    parser.add_argument('--tolerance',type=float,default=0.25)
+    parser.add_argument('--imports',action='store_true',help='check the import time budgets')
+    args = parser.parse_args(argv)
+
+    status = 0
+
+    if args.imports:
+        violations = check_imports(repeat=args.repeat)
+        for v in violations:
+            print(f'OVER BUDGET {v}')
+        if violations:
+            status = 1
+
+    if args.only is not None and not args.only:
+        return status
+
+    import matplotlib
+    matplotlib.use('Agg')
+
+    chunks = {'time' : args.time_chunk} if args.dask else None
+    ds = synthetic_dataset(args.nlat,args.nlon,args.ntime,chunks=chunks)
+
+    results = run_benchmarks(ds,args.only,repeat=args.repeat)
+
+    if args.save:
+        with open(args.save,'w') as f:
+            json.dump({'commit' : git_commit(),
+                       'config' : vars(args),
+                       'results' : results},f,indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if 'config' not in baseline:
+            print(f'WARNING {args.compare} has no config, assuming the same dataset')
+        mismatches = config_mismatches(vars(args),baseline.get('config',{})) if 'config' in baseline else []
+
+        if mismatches:
+            for m in mismatches:
+                print(f'CONFIG MISMATCH {m}')
+            print(f'Not comparing with {args.compare}')
+            status = 1
+        else:
+            regressions = compare(results,baseline['results'],tolerance=args.tolerance)
+            for r in regressions:
+                print(f'REGRESSION {r}')
+            if regressions:
+                status = 1
+
+    return status
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
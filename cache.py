@@ -0,0 +1,182 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+
+
+# Default location and size of the derived fields cache
+default_cache_dir = os.environ.get('CENTAUR_CACHE_DIR',
+                                   os.path.join(os.path.expanduser('~'),'.cache','centaur_utils'))
+default_max_bytes = 20 * 2**30
+
+
+
+def _update_values(h,values):
+    '''
+    Update a hash with array values; object arrays (e.g. strings)
+    are hashed by value rather than by their pointers.
+    '''
+    values = np.asarray(values)
+
+    if values.dtype.kind == 'O':
+        h.update(pd.util.hash_array(values.ravel()).tobytes())
+    else:
+        h.update(np.ascontiguousarray(values).tobytes())
+
+
+
+def source_identity(data):
+    '''
+    Returns a hash identifying a data array or dataset and its source.
+
+    Uses the source file (path, size and modification time) when the data
+    was opened from disk, the dask graph name for dask-backed data and the
+    values of other data, together with names, dimensions and coordinates.
+    Variables opened without chunks are hashed by value too, as they may have
+    been loaded and modified in place: open large files with chunks so that
+    they are identified without being read.
+    '''
+    h = hashlib.sha1()
+
+    source = data.encoding.get('source')
+    if source and os.path.exists(source):
+        st = os.stat(source)
+        h.update(f'{source}|{st.st_size}|{st.st_mtime_ns}'.encode())
+
+    variables = data.data_vars.values() if isinstance(data,xr.Dataset) else [data]
+    for v in variables:
+        h.update(repr((v.name,v.dims,v.shape,str(v.dtype),sorted(v.attrs.items()))).encode())
+        if v.chunks is not None:
+            h.update(v.data.name.encode())
+        else:
+            _update_values(h,v.values)
+
+    for name, coord in data.coords.items():
+        h.update(str(name).encode())
+        _update_values(h,coord.values)
+
+    return h.hexdigest()
+
+
+
+def cache_key(func,data,**kwargs):
+    '''
+    Returns the cache key of func(data,**kwargs).
+    '''
+    h = hashlib.sha1()
+    h.update(source_identity(data).encode())
+    h.update(f'{func.__module__}.{func.__qualname__}'.encode())
+    h.update(repr(sorted(kwargs.items())).encode())
+
+    return h.hexdigest()
+
+
+
+def _entry_size(path):
+
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root,f)) for f in files)
+
+    return size
+
+
+
+def evict(cache_dir=None,max_bytes=None,keep=()):
+    '''
+    Remove the least recently used entries of the cache
+    until its size is below max_bytes.
+    '''
+    cache_dir = default_cache_dir if cache_dir is None else cache_dir
+    max_bytes = default_max_bytes if max_bytes is None else max_bytes
+
+    entries = [os.path.join(cache_dir,e) for e in os.listdir(cache_dir) if e.endswith('.zarr')]
+    entries.sort(key=os.path.getmtime)
+
+    sizes = {e : _entry_size(e) for e in entries}
+    total = sum(sizes.values())
+
+    for e in entries:
+        if total <= max_bytes:
+            break
+        if e in keep:
+            continue
+        shutil.rmtree(e,ignore_errors=True)
+        total -= sizes[e]
+
+
+
+def _open(path):
+
+    ds = xr.open_zarr(path)
+
+    if 'cached_variable' in ds.attrs:
+        return ds[ds.attrs['cached_variable']]
+
+    return ds
+
+
+
+def cached(func,data,cache_dir=None,max_bytes=None,**kwargs):
+    '''
+    Returns func(data,**kwargs), reading it from the derived fields cache
+    when it was already computed for the same source data.
+
+    Results are stored as chunked Zarr stores, named after a hash of
+    the source data identity, the function and its arguments, and the
+    least recently used ones are evicted when the cache exceeds max_bytes.
+
+            Parameters:
+                    func (function): Function returning a DataArray or a Dataset
+                    data (xarray.DataArray or xarray.Dataset): Source data
+                    cache_dir (str): Cache directory (default_cache_dir if None)
+                    max_bytes (int): Maximum size of the cache (default_max_bytes if None)
+                    **kwargs: Other arguments passed to func
+
+            Returns:
+                    result (xarray.DataArray or xarray.Dataset): Lazy result, read from the cache
+    '''
+    cache_dir = default_cache_dir if cache_dir is None else cache_dir
+    os.makedirs(cache_dir,exist_ok=True)
+
+    path = os.path.join(cache_dir,cache_key(func,data,**kwargs)+'.zarr')
+
+    if os.path.exists(path):
+        # Mark as recently used
+        os.utime(path)
+        return _open(path)
+
+    result = func(data,**kwargs)
+
+    if isinstance(result,xr.DataArray):
+        name = result.name if result.name is not None else 'data'
+        ds = result.to_dataset(name=name)
+        ds.attrs['cached_variable'] = name
+    else:
+        ds = result
+
+    # Write to a temporary store, then move it in place
+    tmp = f'{path}.{os.getpid()}.tmp'
+    ds.to_zarr(tmp,mode='w')
+    try:
+        os.rename(tmp,path)
+    except OSError:
+        # Written meanwhile by another process
+        shutil.rmtree(tmp,ignore_errors=True)
+
+    evict(cache_dir,max_bytes,keep=(path,))
+
+    return _open(path)
+
+
+
+def cached_reduction(da,op,dim=None,cache_dir=None,max_bytes=None):
+    '''
+    Reduction of a data array ('min', 'max', 'mean', ...) through the cache,
+    e.g. cached_reduction(prec,'max',dim='time').
+    '''
+    return cached(getattr(xr.DataArray,op),da,cache_dir=cache_dir,max_bytes=max_bytes,dim=dim)
@@ -0,0 +1,192 @@
+import dask
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from grids import fix_coordinates, EARTH_RADIUS
+
+
+
+def _block_slices(chunks):
+    '''
+    Index and slices of each block of a chunked array, in C order.
+    '''
+    offsets = [np.cumsum((0,)+tuple(c)) for c in chunks]
+
+    for idx in np.ndindex(*[len(c) for c in chunks]):
+        yield idx, tuple(slice(o[i],o[i+1]) for o, i in zip(offsets,idx))
+
+
+
+def _label_faces(block,threshold):
+    '''
+    Label the exceedance clusters of a block and return
+    their number and the labels on the faces of the block.
+    '''
+    labels, n = ndimage.label(block >= threshold)
+    faces = tuple((labels.take(0,axis=a),labels.take(-1,axis=a)) for a in range(block.ndim))
+
+    return n, faces
+
+
+
+def _block_events(block,threshold,offset,mapping,t0,lat,lon,cell_area):
+    '''
+    Per (event, time step) statistics of the clusters of a block.
+    '''
+    labels, _ = ndimage.label(block >= threshold)
+    inside = labels > 0
+
+    columns = ['event','time_index','cells','area','lat_w','lon_w','max_rp','peak_lat','peak_lon']
+    if not inside.any():
+        return pd.DataFrame(columns=columns)
+
+    t, i, j = np.nonzero(inside)
+    area = cell_area[i]
+
+    df = pd.DataFrame({'event' : mapping[labels[inside]+offset],
+                       'time_index' : t+t0,
+                       'area' : area,
+                       'lat_w' : lat[i]*area,
+                       'lon_w' : lon[j]*area,
+                       'rp' : block[inside],
+                       'lat' : lat[i],
+                       'lon' : lon[j]})
+
+    return _combine(df.rename(columns={'rp' : 'max_rp','lat' : 'peak_lat','lon' : 'peak_lon'})
+                      .assign(cells=1))[columns]
+
+
+
+def _combine(df):
+    '''
+    Merge rows of the same event and time step: sums of cells and areas,
+    maximum return period and its location.
+    '''
+    df = df.sort_values('max_rp',ascending=False,kind='stable')
+
+    return (df.groupby(['event','time_index'],sort=False)
+              .agg(cells=('cells','sum'),
+                   area=('area','sum'),
+                   lat_w=('lat_w','sum'),
+                   lon_w=('lon_w','sum'),
+                   max_rp=('max_rp','first'),
+                   peak_lat=('peak_lat','first'),
+                   peak_lon=('peak_lon','first'))
+              .reset_index())
+
+
+
+def detect_events(return_period,threshold=10,chunks=None,min_cells=1):
+    '''
+    Detect extreme events as clusters of grid points exceeding a return period,
+    connected in space and time (faces of the (time, lat, lon) cells).
+
+    The field is scanned block by block in parallel: clusters are labelled
+    within each dask chunk, joined across chunk borders by comparing the
+    labels on the shared faces, and summarized per chunk, so the whole
+    archive is never held in memory.
+
+            Parameters:
+                    return_period (xarray.DataArray): Return period (time, latitude, longitude)
+                    threshold (float): Return period threshold, e.g. one of the clevs_rp levels
+                    chunks (dict): Chunks to use, the chunks of the data if None
+                    min_cells (int): Minimum number of (time, grid point) cells of an event
+
+            Returns:
+                    events (pandas.DataFrame): One row per event, by decreasing maximum return period:
+                                               start, end and peak time, maximum return period and its location,
+                                               area-weighted centroid, peak and maximum area (km2), number of cells
+    '''
+
+    rp = fix_coordinates(return_period).transpose('time','latitude','longitude')
+
+    if chunks is not None:
+        rp = rp.chunk(chunks)
+    elif rp.chunks is None:
+        rp = rp.chunk()
+
+    data = rp.data
+    lat = rp['latitude'].values
+    lon = rp['longitude'].values
+    time = rp['time'].values
+
+    # Grid cell areas (km2), by latitude
+    dlat = np.abs(np.gradient(lat)) if lat.size > 1 else np.array([1.])
+    dlon = np.abs(np.gradient(lon)).mean() if lon.size > 1 else 1.
+    cell_area = EARTH_RADIUS**2*np.deg2rad(dlat)*np.deg2rad(dlon)*np.cos(np.deg2rad(lat))
+
+    blocks = data.to_delayed()
+    slices = list(_block_slices(data.chunks))
+
+    # First pass: clusters within each block and labels on the block faces
+    first = dask.compute(*[dask.delayed(_label_faces)(blocks[idx],threshold) for idx, _ in slices])
+
+    counts = np.array([n for n, _ in first])
+    offsets = np.concatenate(([0],np.cumsum(counts)[:-1]))
+    total = int(counts.sum())
+
+    block_number = {idx : b for b, (idx, _) in enumerate(slices)}
+
+    # Clusters touching across the faces of neighbouring blocks
+    rows, cols = [], []
+    for b, (idx, _) in enumerate(slices):
+        for a in range(3):
+            nidx = idx[:a] + (idx[a]+1,) + idx[a+1:]
+            if nidx not in block_number:
+                continue
+            nb = block_number[nidx]
+            high = first[b][1][a][1]
+            low = first[nb][1][a][0]
+            both = (high > 0) & (low > 0)
+            rows.append(high[both]+offsets[b])
+            cols.append(low[both]+offsets[nb])
+
+    rows = np.concatenate(rows) if rows else np.zeros(0,dtype=int)
+    cols = np.concatenate(cols) if cols else np.zeros(0,dtype=int)
+
+    graph = coo_matrix((np.ones(rows.size,dtype=np.int8),(rows,cols)),shape=(total+1,total+1))
+    _, components = connected_components(graph,directed=False)
+
+    # Global event number of each block label (0 is the background)
+    _, mapping = np.unique(components,return_inverse=True)
+
+    # Second pass: statistics of the events in each block
+    parts = dask.compute(*[dask.delayed(_block_events)(blocks[idx],threshold,offsets[b],mapping,
+                                                      s[0].start,lat[s[1]],lon[s[2]],cell_area[s[1]])
+                           for b, (idx, s) in enumerate(slices)])
+
+    steps = _combine(pd.concat(parts,ignore_index=True))
+
+    columns = ['event','start_time','end_time','peak_time','max_rp','peak_lat','peak_lon',
+               'centroid_lat','centroid_lon','peak_area_km2','max_area_km2','cells']
+    if steps.empty:
+        return pd.DataFrame(columns=columns)
+
+    steps = steps.sort_values('max_rp',ascending=False,kind='stable')
+    grouped = steps.groupby('event',sort=False)
+
+    events = grouped.agg(start=('time_index','min'),
+                         end=('time_index','max'),
+                         peak=('time_index','first'),
+                         max_rp=('max_rp','first'),
+                         peak_lat=('peak_lat','first'),
+                         peak_lon=('peak_lon','first'),
+                         peak_area_km2=('area','first'),
+                         max_area_km2=('area','max'),
+                         area=('area','sum'),
+                         lat_w=('lat_w','sum'),
+                         lon_w=('lon_w','sum'),
+                         cells=('cells','sum')).reset_index()
+
+    events = events.loc[events['cells'] >= min_cells].copy()
+
+    events['start_time'] = time[events['start'].to_numpy()]
+    events['end_time'] = time[events['end'].to_numpy()]
+    events['peak_time'] = time[events['peak'].to_numpy()]
+    events['centroid_lat'] = events['lat_w']/events['area']
+    events['centroid_lon'] = events['lon_w']/events['area']
+
+    return events[columns].reset_index(drop=True)
@@ -0,0 +1,352 @@
+import numpy as np
+import xarray as xr
+from scipy.special import gamma
+
+from grids import fix_coordinates
+from cache import cached
+
+
+
+# Euler-Mascheroni constant
+EULER_GAMMA = 0.5772156649015329
+
+# Return periods (years) of the rpNN threshold fields
+return_periods = (2, 5, 10, 20, 50, 100, 500)
+
+
+
+#############################
+# L-moments
+#############################
+
+def lmoments(x):
+    '''
+    First three L-moments of samples along the last axis, ignoring NaN.
+    Samples with less than 3 values give NaN.
+
+            Parameters:
+                    x (numpy.ndarray): Samples, along the last axis
+
+            Returns:
+                    l1, l2, l3 (numpy.ndarray): L-moments
+    '''
+
+    # NaN are sorted last, so valid values have ranks 0..n-1
+    x = np.sort(x,axis=-1)
+    n = np.sum(~np.isnan(x),axis=-1)
+    x = np.nan_to_num(x)
+
+    j = np.arange(x.shape[-1],dtype=float)
+    nn = n[...,np.newaxis].astype(float)
+
+    # Probability weighted moments (unbiased estimators)
+    with np.errstate(invalid='ignore',divide='ignore'):
+        b0 = x.sum(axis=-1)/n
+        b1 = (x*j/(nn-1)).sum(axis=-1)/n
+        b2 = (x*j*(j-1)/((nn-1)*(nn-2))).sum(axis=-1)/n
+
+    l1 = b0
+    l2 = 2*b1 - b0
+    l3 = 6*b2 - 6*b1 + b0
+
+    invalid = n < 3
+
+    return (np.where(invalid,np.nan,l1),
+            np.where(invalid,np.nan,l2),
+            np.where(invalid,np.nan,l3))
+
+
+
+def _fit(sample,dim,func,names):
+    '''
+    Apply a fitting function along dim, in parallel over the other dims.
+    '''
+
+    # Whole record in each chunk, split in space so that each task stays small
+    if sample.chunks is not None:
+        sample = sample.chunk({d : -1 if d == dim else 'auto' for d in sample.dims})
+
+    params = xr.apply_ufunc(func,sample,
+                            input_core_dims=[[dim]],
+                            output_core_dims=[['parameter']],
+                            dask='parallelized',
+                            output_dtypes=[float],
+                            dask_gufunc_kwargs={'output_sizes' : {'parameter' : len(names)}})
+
+    return xr.Dataset({name : params.isel(parameter=i) for i, name in enumerate(names)})
+
+
+
+def _gumbel_lmom(x):
+
+    l1, l2, _ = lmoments(x)
+
+    scale = l2/np.log(2)
+    loc = l1 - EULER_GAMMA*scale
+
+    return np.stack((loc,scale),axis=-1)
+
+
+
+def _gev_lmom(x):
+
+    l1, l2, l3 = lmoments(x)
+
+    # Hosking (1985) approximation of the shape parameter
+    with np.errstate(invalid='ignore',divide='ignore'):
+        t3 = l3/l2
+        c = 2/(3+t3) - np.log(2)/np.log(3)
+        k = 7.8590*c + 2.9554*c**2
+
+        gk = gamma(1+k)
+        scale = l2*k/((1-2**(-k))*gk)
+        loc = l1 - scale*(1-gk)/k
+
+    # Gumbel limit
+    gumbel = np.abs(k) < 1e-6
+    scale = np.where(gumbel,l2/np.log(2),scale)
+    loc = np.where(gumbel,l1-EULER_GAMMA*l2/np.log(2),loc)
+    k = np.where(gumbel,0.,k)
+
+    return np.stack((loc,scale,k),axis=-1)
+
+
+
+def _gpd_lmom(x,quantile):
+
+    with np.errstate(invalid='ignore'):
+        threshold = np.nanquantile(x,quantile,axis=-1)
+        excess = np.where(x > threshold[...,np.newaxis],x-threshold[...,np.newaxis],np.nan)
+
+    n_excess = np.sum(~np.isnan(excess),axis=-1)
+    l1, l2, _ = lmoments(excess)
+
+    # Location of the excesses is 0
+    with np.errstate(invalid='ignore',divide='ignore'):
+        k = l1/l2 - 2
+        scale = l1*(1+k)
+
+    return np.stack((threshold,scale,k,n_excess),axis=-1)
+
+
+
+#############################
+# Fitting
+#############################
+
+def annual_maxima(prec,dim='time'):
+    '''
+    Annual maxima of a time series (lazy if prec is dask-backed).
+    '''
+    return fix_coordinates(prec).resample({dim : 'YS'}).max()
+
+
+
+def fit_gumbel(maxima,dim='time'):
+    '''
+    Fit a Gumbel distribution to the annual maxima of each grid point (L-moments).
+
+            Parameters:
+                    maxima (xarray.DataArray): Annual maxima, e.g. from annual_maxima
+                    dim (str): Dimension of the samples
+
+            Returns:
+                    params (xarray.Dataset): loc and scale
+    '''
+    params = _fit(maxima,dim,_gumbel_lmom,['loc','scale'])
+    params.attrs['distribution'] = 'gumbel'
+
+    return params
+
+
+
+def fit_gev(maxima,dim='time'):
+    '''
+    Fit a GEV distribution to the annual maxima of each grid point (L-moments).
+    The shape follows Hosking's convention (shape > 0: bounded upper tail).
+
+            Parameters:
+                    maxima (xarray.DataArray): Annual maxima, e.g. from annual_maxima
+                    dim (str): Dimension of the samples
+
+            Returns:
+                    params (xarray.Dataset): loc, scale and shape
+    '''
+    params = _fit(maxima,dim,_gev_lmom,['loc','scale','shape'])
+    params.attrs['distribution'] = 'gev'
+
+    return params
+
+
+
+def fit_gpd(prec,quantile=0.99,dim='time'):
+    '''
+    Fit a generalized Pareto distribution to the peaks over threshold
+    of each grid point (L-moments). The threshold is the given quantile
+    of each series; exceedances are assumed independent (no declustering).
+    The shape follows Hosking's convention.
+
+            Parameters:
+                    prec (xarray.DataArray): Time series, e.g. 6-hourly precipitation
+                    quantile (float): Quantile used as threshold
+                    dim (str): Time dimension
+
+            Returns:
+                    params (xarray.Dataset): threshold, scale, shape
+                                             and rate (exceedances per year)
+    '''
+    prec = fix_coordinates(prec)
+
+    time = prec[dim].values
+    years = (time[-1] - time[0]) / np.timedelta64(1,'D') / 365.25
+
+    params = _fit(prec,dim,lambda x: _gpd_lmom(x,quantile),
+                  ['threshold','scale','shape','n_excess'])
+
+    params['rate'] = params['n_excess']/years
+    params = params.drop_vars('n_excess')
+    params.attrs['distribution'] = 'gpd'
+
+    return params
+
+
+
+#############################
+# Return levels and periods
+#############################
+
+def return_levels(params,periods=return_periods):
+    '''
+    Return levels of the fitted distributions.
+
+            Parameters:
+                    params (xarray.Dataset): Parameters from fit_gumbel, fit_gev or fit_gpd
+                    periods (iterable): Return periods (years)
+
+            Returns:
+                    levels (xarray.Dataset): rpNN variables, one per return period,
+                                             as used by plots.scatter_rp_prec and maps.plot_threshold
+    '''
+
+    distribution = params.attrs['distribution']
+    levels = xr.Dataset()
+
+    for T in periods:
+
+        if distribution == 'gumbel':
+            level = params['loc'] - params['scale']*np.log(-np.log(1-1/T))
+
+        elif distribution == 'gev':
+            y = -np.log(1-1/T)
+            k = params['shape']
+            gumbel = params['loc'] - params['scale']*np.log(y)
+            level = xr.where(k == 0,gumbel,params['loc'] + params['scale']/k*(1-y**k))
+
+        elif distribution == 'gpd':
+            m = params['rate']*T
+            k = params['shape']
+            exponential = params['threshold'] + params['scale']*np.log(m)
+            level = xr.where(k == 0,exponential,params['threshold'] + params['scale']/k*(1-m**(-k)))
+
+        else:
+            raise ValueError(f'Unknown distribution: {distribution}')
+
+        levels[f'rp{T}'] = level.assign_attrs(long_name=f'{T} years return level')
+
+    return levels
+
+
+
+def return_period(values,params):
+    '''
+    Return period of each value of a field, from the fitted distributions (lazy).
+
+            Parameters:
+                    values (xarray.DataArray): Field, e.g. 6-hourly precipitation
+                    params (xarray.Dataset): Parameters from fit_gumbel, fit_gev or fit_gpd
+
+            Returns:
+                    rp (xarray.DataArray): Return period (years), starting from 1,
+                                           as used by maps.plot_return_period;
+                                           NaN above the upper bound of a fitted
+                                           GEV or GPD (shape > 0)
+    '''
+
+    distribution = params.attrs['distribution']
+    x = fix_coordinates(values)
+
+    if distribution == 'gumbel':
+        cdf = np.exp(-np.exp(-(x-params['loc'])/params['scale']))
+        exceedance = 1 - cdf
+
+    elif distribution == 'gev':
+        k = params['shape']
+        s = (x-params['loc'])/params['scale']
+        z = 1 - k*s
+        gev = np.exp(-np.abs(z)**(1/xr.where(k == 0,1,k)))
+        # Out of the support: above the upper bound (k>0) or below the lower bound (k<0)
+        gev = xr.where(z > 0,gev,xr.where(k > 0,1.,0.))
+        cdf = xr.where(k == 0,np.exp(-np.exp(-s)),gev)
+        exceedance = (1 - cdf).where((z > 0) | (k <= 0))
+
+    elif distribution == 'gpd':
+        k = params['shape']
+        s = (x-params['threshold'])/params['scale']
+        z = 1 - k*s
+        gpd = xr.where(z > 0,np.abs(z)**(1/xr.where(k == 0,1,k)),0.)
+        survival = xr.where(k == 0,np.exp(-s),gpd)
+        # Values below the threshold: as frequent as the exceedances
+        survival = xr.where(s > 0,survival,1.)
+        # Exceedances per year
+        exceedance = (params['rate']*survival).where((z > 0) | (k <= 0))
+
+    else:
+        raise ValueError(f'Unknown distribution: {distribution}')
+
+    def _reciprocal(e):
+        with np.errstate(divide='ignore'):
+            return 1/e
+
+    # In the kernel, so that the errstate holds when the (lazy) chunks are computed
+    rp = xr.apply_ufunc(_reciprocal,exceedance,dask='parallelized',output_dtypes=[float])
+
+    rp = rp.clip(min=1).where(x.notnull())
+
+    return rp.rename('return_period').assign_attrs(long_name='Return period',units='years')
+
+
+
+def compute_return_periods(prec,distribution='gev',periods=return_periods,quantile=0.99,cache_dir=None):
+    '''
+    Fit extreme value distributions to each grid point of a precipitation
+    time series, returning the return level maps and the return period
+    of each value. Everything stays lazy for dask-backed input.
+
+            Parameters:
+                    prec (xarray.DataArray): Time series, e.g. 6-hourly precipitation
+                    distribution (str): 'gev' or 'gumbel' (annual maxima), or 'gpd' (peaks over threshold)
+                    periods (iterable): Return periods (years) of the return levels
+                    quantile (float): Threshold quantile, for 'gpd' only
+                    cache_dir (str): If given, the fitted parameters are stored in
+                                     (and read from) this derived fields cache
+
+            Returns:
+                    levels (xarray.Dataset): rpNN return levels
+                    rp (xarray.DataArray): Return period of each value of prec
+    '''
+
+    if distribution == 'gev':
+        func, sample, kwargs = fit_gev, annual_maxima(prec), {}
+    elif distribution == 'gumbel':
+        func, sample, kwargs = fit_gumbel, annual_maxima(prec), {}
+    elif distribution == 'gpd':
+        func, sample, kwargs = fit_gpd, prec, {'quantile' : quantile}
+    else:
+        raise ValueError(f'Unknown distribution: {distribution}')
+
+    if cache_dir is None:
+        params = func(sample,**kwargs)
+    else:
+        params = cached(func,sample,cache_dir=cache_dir,**kwargs)
+
+    return return_levels(params,periods), return_period(prec,params)
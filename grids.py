@@ -1,5 +1,20 @@
+import hashlib
+from itertools import chain
+
 import numpy as np
-import geopandas as gpd
+import xarray as xr
+
+# geopandas and scipy are imported by the functions that use them,
+# so that importing this module stays fast
+
+
+# Mean Earth radius (km)
+EARTH_RADIUS = 6371.0
+
+# GridIndex objects already built, keyed by coordinates hash,
+# up to a total size (bytes)
+_grid_index_cache = {}
+_grid_index_cache_bytes = 2**30
 
 
 
@@ -14,39 +29,552 @@ def fix_coordinates(ds):
 
 
 
+def lonlat_to_xyz(lat,lon):
+    '''
+    Convert geographic coordinates (degrees) to
+    cartesian coordinates on the unit sphere.
+    '''
+    lat = np.deg2rad(np.asarray(lat,dtype=float))
+    lon = np.deg2rad(np.asarray(lon,dtype=float))
+
+    return np.stack((np.cos(lat)*np.cos(lon),
+                     np.cos(lat)*np.sin(lon),
+                     np.sin(lat)),axis=-1)
+
+
+
+def _nearest_on_axis(coord,order,values,period=None):
+    '''
+    Index of the nearest value of a sorted 1-D coordinate (coord[k] is
+    at index order[k] of the grid), wrapping around with a period.
+    '''
+    if coord.size == 1:
+        return np.zeros(np.shape(values),dtype=np.intp)
+
+    if period is not None:
+        coord = np.concatenate((coord[-1:]-period,coord,coord[:1]+period))
+        order = np.concatenate((order[-1:],order,order[:1]))
+
+    i = np.clip(np.searchsorted(coord,values),1,coord.size-1)
+    i = i - ((values-coord[i-1]) < (coord[i]-values))
+
+    return order[i]
+
+
+
+def wrap_lon(lon):
+    '''
+    Longitudes in -180..180.
+    '''
+    return (np.asarray(lon,dtype=float)+180) % 360 - 180
+
+
+
+class GridIndex:
+    '''
+    Spatial index of the points of a lat/lon grid.
+
+    Regular grids (1-D coordinates) are searched along each axis
+    with a binary search, longitudes wrapping around. Curvilinear grids
+    (2-D coordinates) are stored in a KD-tree on the unit sphere, so that
+    nearest neighbour queries take O(log n) and use great-circle distance.
+
+            Parameters:
+                    lats (numpy.ndarray): Latitudes of the grid, 1-D or 2-D
+                    lons (numpy.ndarray): Longitudes of the grid, 1-D or 2-D
+                    dims (tuple): Names of the grid dimensions
+    '''
+
+    def __init__(self,lats,lons,dims=('longitude','latitude')):
+
+        lats = np.asarray(lats,dtype=float)
+        lons = np.asarray(lons,dtype=float)
+
+        self.dims = tuple(dims)
+        self.regular = lats.ndim == 1 and lons.ndim == 1
+
+        # Regular grid: points ordered as (longitude, latitude)
+        # as returned by closest_gridpoint_indexes
+        if self.regular:
+            self.shape = (lons.size,lats.size)
+            self.lat = lats
+            self.lon = lons
+            self._lat_order = np.argsort(lats)
+            self._lat_sorted = lats[self._lat_order]
+            self._lon_order = np.argsort(wrap_lon(lons))
+            self._lon_sorted = wrap_lon(lons)[self._lon_order]
+            self.tree = None
+            self.nbytes = 3*(lats.nbytes+lons.nbytes)
+            return
+
+        if lats.shape != lons.shape:
+            raise ValueError('Latitude and longitude arrays have different shapes')
+
+        self.shape = lats.shape
+        self.lats = lats.ravel()
+        self.lons = lons.ravel()
+
+        from scipy.spatial import cKDTree
+        self.tree = cKDTree(lonlat_to_xyz(self.lats,self.lons))
+        self.nbytes = self.lats.nbytes + self.lons.nbytes + self.tree.data.nbytes + self.tree.indices.nbytes
+
+        # Tree in (lon, lat) degrees, built when first needed
+        self._planar_tree = None
+
+
+    @classmethod
+    def from_dataset(cls,dataset):
+        '''
+        Build the index of the grid of an xarray Dataset or DataArray.
+        '''
+        ds = fix_coordinates(dataset)
+
+        lats = ds['latitude']
+        lons = ds['longitude']
+
+        if lats.ndim == 1 and lons.ndim == 1:
+            dims = (lons.dims[0],lats.dims[0])
+        else:
+            dims = lats.dims
+
+        return cls(lats.values,lons.values,dims=dims)
+
+
+    def query(self,lat,lon):
+        '''
+        Returns the indexes of the grid points closest
+        to one or more locations.
+
+                Parameters:
+                        lat (float or array-like): Latitude of locations
+                        lon (float or array-like): Longitude of locations
+
+                Returns:
+                        indexes (tuple): Indexes along each grid dimension (see self.dims)
+                        distance (numpy.ndarray): Great-circle distance (km) from the grid points
+        '''
+        if self.regular:
+            lat = np.asarray(lat,dtype=float)
+            lon = np.asarray(lon,dtype=float)
+
+            ilat = _nearest_on_axis(self._lat_sorted,self._lat_order,lat)
+            ilon = _nearest_on_axis(self._lon_sorted,self._lon_order,wrap_lon(lon),period=360)
+
+            return (ilon,ilat), haversine(lat,lon,self.lat[ilat],self.lon[ilon])
+
+        chord, flat = self.tree.query(lonlat_to_xyz(lat,lon))
+
+        indexes = np.unravel_index(flat,self.shape)
+        distance = 2*EARTH_RADIUS*np.arcsin(np.clip(chord/2,0,1))
+
+        return indexes, distance
+
+
+    def _box_candidates(self,lat,lon,dlat,dlon):
+        '''
+        Flat indexes and coordinates of the points of a regular grid
+        within dlat and dlon (degrees) from a location, longitudes
+        relative to the location.
+        '''
+        lo = np.searchsorted(self._lat_sorted,lat-dlat,side='left')
+        hi = np.searchsorted(self._lat_sorted,lat+dlat,side='right')
+        ilat = self._lat_order[lo:hi]
+
+        delta = wrap_lon(self.lon-lon)
+        ilon = np.flatnonzero(np.abs(delta) <= dlon)
+
+        ILON, ILAT = np.meshgrid(ilon,ilat,indexing='ij')
+        LON = lon + delta[ILON]
+        LAT = self.lat[ILAT]
+
+        return np.ravel_multi_index((ILON.ravel(),ILAT.ravel()),self.shape), LAT.ravel(), LON.ravel()
+
+
+    def _query_radius_regular(self,lat,lon,radius,units,circles=None):
+        import shapely
+
+        matches = []
+        for i, (la, lo, r) in enumerate(zip(lat,lon,radius)):
+
+            if units == 'degrees':
+                dlat = dlon = r
+            else:
+                dlat = np.rad2deg(r/EARTH_RADIUS)
+                coslat = np.cos(np.deg2rad(la))
+                dlon = dlat/coslat if coslat > np.sin(np.deg2rad(min(dlat,90))) else 180
+
+            flat, LAT, LON = self._box_candidates(la,lo,dlat,dlon)
+
+            if units == 'degrees':
+                inside = shapely.contains_xy(circles[i],LON,LAT)
+            else:
+                inside = haversine(la,lo,LAT,LON) <= r
+
+            matches.append(np.sort(flat[inside]))
+
+        return matches
+
+
+    def query_radius(self,lat,lon,radius,units='degrees'):
+        '''
+        Returns the grid points within a given distance
+        from one or more locations, as a ragged array.
+
+                Parameters:
+                        lat (float or array-like): Latitude of locations
+                        lon (float or array-like): Longitude of locations
+                        radius (float or array-like): Radius around each location
+                        units (str): 'degrees' (the same polygon buffer as in_circle) or 'km' (great-circle distance)
+
+                Returns:
+                        offsets (numpy.ndarray): Matches of location i are at offsets[i]:offsets[i+1]
+                        indexes (tuple): Indexes along each grid dimension (see self.dims)
+        '''
+        lat = np.atleast_1d(np.asarray(lat,dtype=float))
+        lon = np.atleast_1d(np.asarray(lon,dtype=float))
+        radius = np.broadcast_to(np.asarray(radius,dtype=float),lat.shape)
+
+        if units not in ('degrees','km'):
+            raise ValueError(f'Unknown units: {units}')
+
+        # Same polygon approximation of the circles as in_circle
+        circles = None
+        if units == 'degrees':
+            import shapely
+            circles = shapely.buffer(shapely.points(lon,lat),radius,quad_segs=16)
+
+        if self.regular:
+            matches = self._query_radius_regular(lat,lon,radius,units,circles)
+        elif units == 'degrees':
+            if self._planar_tree is None:
+                from scipy.spatial import cKDTree
+                self._planar_tree = cKDTree(np.column_stack((self.lons,self.lats)))
+            candidates = self._planar_tree.query_ball_point(np.column_stack((lon,lat)),
+                                                            r=radius,return_sorted=True)
+            matches = [np.asarray(c,dtype=np.intp)[shapely.contains_xy(circle,self.lons[c],self.lats[c])]
+                       for c, circle in zip(candidates,circles)]
+        elif units == 'km':
+            chord = 2*np.sin(np.minimum(radius/EARTH_RADIUS,np.pi)/2)
+            matches = self.tree.query_ball_point(lonlat_to_xyz(lat,lon),
+                                                 r=chord,return_sorted=True)
+
+        counts = np.fromiter((len(m) for m in matches),dtype=np.intp,count=len(matches))
+        offsets = np.concatenate(([0],np.cumsum(counts)))
+        flat = np.fromiter(chain.from_iterable(matches),dtype=np.intp,count=offsets[-1])
+
+        return offsets, np.unravel_index(flat,self.shape)
+
+
+    def isel_indexers(self,lat,lon,dim='points'):
+        '''
+        Returns a dict of indexers for a pointwise .isel()
+        at the grid points closest to the given locations.
+        '''
+        indexes, _ = self.query(np.atleast_1d(lat),np.atleast_1d(lon))
+
+        return {d : xr.DataArray(i,dims=dim) for d, i in zip(self.dims,indexes)}
+
+
+
+def grid_hash(dataset):
+    '''
+    Hash of the lat/lon coordinates of a dataset.
+    '''
+    ds = fix_coordinates(dataset)
+
+    h = hashlib.sha1()
+    for name in ('latitude','longitude'):
+        coord = np.ascontiguousarray(ds[name].values,dtype=float)
+        h.update(name.encode())
+        h.update(str(coord.shape).encode())
+        h.update(coord.tobytes())
+
+    return h.hexdigest()
+
+
+
+def get_grid_index(dataset):
+    '''
+    Returns the GridIndex of the grid of the given dataset,
+    building it only if the same grid was not seen before.
+    '''
+    key = grid_hash(dataset)
+
+    if key not in _grid_index_cache:
+        index = GridIndex.from_dataset(dataset)
+
+        # Evict the oldest indexes to stay within the cache size
+        while _grid_index_cache and \
+              sum(i.nbytes for i in _grid_index_cache.values()) + index.nbytes > _grid_index_cache_bytes:
+            _grid_index_cache.pop(next(iter(_grid_index_cache)))
+
+        _grid_index_cache[key] = index
+
+    return _grid_index_cache[key]
+
+
+
+def crop(dataarray,bbox=None,center=None,radius=None):
+    '''
+    Lazily select the part of a data array within a bounding box,
+    so that only the data inside it is read.
+    Handles ascending and descending latitudes, 0-360 longitudes
+    and boxes across the edge of the longitude range.
+
+            Parameters:
+                    dataarray (xarray.DataArray or xarray.Dataset): Data to crop
+                    bbox (tuple): (lon_min, lon_max, lat_min, lat_max), as cartopy extents
+                    center (dict): Centre of the box, with 'lat' and 'lon' keys (if bbox is None)
+                    radius (float): Half side of the box around center (degrees)
+
+            Returns:
+                    cropped (xarray.DataArray or xarray.Dataset), unchanged if no box is given
+    '''
+
+    # Fix coordinates if needed
+    da = fix_coordinates(dataarray)
+
+    if bbox is None:
+        if center is None or radius is None:
+            return da
+        bbox = (center['lon']-radius,center['lon']+radius,
+                center['lat']-radius,center['lat']+radius)
+
+    lon_min, lon_max, lat_min, lat_max = bbox
+
+    lat = da['latitude']
+    lon = da['longitude']
+
+    if lat.ndim == 1 and lon.ndim == 1:
+
+        # Latitude slice in the order of the coordinate
+        if lat.values[0] > lat.values[-1]:
+            da = da.sel({lat.dims[0] : slice(lat_max,lat_min)})
+        else:
+            da = da.sel({lat.dims[0] : slice(lat_min,lat_max)})
+
+        # Longitudes in the convention of the data (0-360 or -180-180)
+        east_360 = lon.values.max() > 180
+        if east_360:
+            lon_min, lon_max = [x+360 if x < 0 else x for x in (lon_min,lon_max)]
+        else:
+            lon_min, lon_max = [x-360 if x > 180 else x for x in (lon_min,lon_max)]
+
+        dim = lon.dims[0]
+        if lon_min <= lon_max:
+            return da.sel({dim : slice(lon_min,lon_max)})
+
+        # Box across the edge of the longitude range:
+        # join the two parts with continuous longitudes
+        west = da.sel({dim : slice(lon_min,None)})
+        east = da.sel({dim : slice(None,lon_max)})
+        if east_360:
+            west = west.assign_coords({dim : west[dim]-360})
+        else:
+            east = east.assign_coords({dim : east[dim]+360})
+
+        return xr.concat((west,east),dim=dim)
+    
+    # Curvilinear grid: smallest index box containing the points inside
+    LAT, LON = xr.broadcast(lat,lon)
+    inside = (LAT.values >= lat_min) & (LAT.values <= lat_max) & \
+             ((LON.values-lon_min) % 360 <= (lon_max-lon_min) % 360)
+    
+    rows, cols = np.nonzero(inside)
+    if rows.size == 0:
+        raise ValueError(f'No grid point in {bbox}')
+    
+    return da.isel({LAT.dims[0] : slice(rows.min(),rows.max()+1),
+                    LAT.dims[1] : slice(cols.min(),cols.max()+1)})
+
+
+
+def split_extent(extent):
+    '''
+    Returns an extent (lon_min, lon_max, lat_min, lat_max) with longitudes in any
+    convention (0-360, across the dateline) as extents within -180..180,
+    split at the antimeridian if needed.
+    '''
+    x0, x1, y0, y1 = map(float,extent)
+
+    if x1 - x0 >= 360:
+        return ((-180.,180.,y0,y1),)
+
+    x0n = (x0+180) % 360 - 180
+    x1n = x0n + (x1-x0)
+
+    if x1n <= 180:
+        return ((x0n,x1n,y0,y1),)
+
+    return ((x0n,180.,y0,y1),(-180.,x1n-360,y0,y1))
+
+
+
 def closest_gridpoint_indexes(lat,lon,dataset):
     '''
     Returns the indexes of the grid point
     closest to the given location.
 
             Parameters:
-                    lat (float): Latitude of location
-                    lon (float): Longitude of location
+                    lat (float or array-like): Latitude of location(s)
+                    lon (float or array-like): Longitude of location(s)
                     ds (xarray.Dataset): Target dataset 
 
             Returns:
                     xloc, yloc (numpy.int64, numpy.int64): x and y indexes of the grid point closest to location
+                                                           (arrays of indexes if arrays of locations are given)
     '''
     
-    # Fix coordinates names if needed
-    ds = fix_coordinates(dataset)
-    
-    abslon = np.abs(ds.longitude-lon)
-    abslat = np.abs(ds.latitude-lat)
-    
-    c = np.maximum(abslon, abslat)
-    
-    ([xloc], [yloc]) = np.where(c == np.min(c))
+    index = get_grid_index(dataset)
+
+    (xloc, yloc), _ = index.query(lat,lon)
     
     return xloc, yloc
 
 
 
-def in_circle(dataarray,center,radius=0.2):
+def haversine(lat1,lon1,lat2,lon2):
+    '''
+    Great-circle distance (km) between points, vectorized.
+    '''
+    lat1, lon1, lat2, lon2 = map(np.deg2rad,(lat1,lon1,lat2,lon2))
+
+    a = np.sin((lat2-lat1)/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin((lon2-lon1)/2)**2
+
+    return 2*EARTH_RADIUS*np.arcsin(np.sqrt(np.clip(a,0,1)))
+
+
+
+def in_circle_mask(dataarray,center,radius=0.2,units='degrees'):
+    '''
+    Returns a boolean mask of the grid points within
+    a given distance from a location.
+
+    The mask is computed once on the lat/lon grid, only for the points
+    in the bounding box of the circle, and does not depend on time.
+
+            Parameters:
+                    dataarray (xarray.DataArray): Target data array
+                    center (dict): Location, with 'lat' and 'lon' keys
+                    radius (float): Radius of the circle
+                    units (str): 'degrees' (the same polygon buffer as in_circle) or 'km' (great-circle distance)
+
+            Returns:
+                    mask (xarray.DataArray): True for grid points within the circle
+    '''
 
     # Fix coordinates if needed
     da = fix_coordinates(dataarray)
 
+    lat = da['latitude']
+    lon = da['longitude']
+
+    # Half sides of the bounding box
+    if units == 'degrees':
+        import shapely
+
+        # Same polygon approximation of the circle as the geopandas buffer
+        circle = shapely.Point(center['lon'],center['lat']).buffer(radius,quad_segs=16)
+
+        dlat = dlon = radius
+        delta_lon = lambda x: x - center['lon']
+        inside = lambda LAT, LON: shapely.contains_xy(circle,LON,LAT)
+    elif units == 'km':
+        dlat = np.rad2deg(radius/EARTH_RADIUS)
+        coslat = np.cos(np.deg2rad(center['lat']))
+        dlon = dlat/coslat if coslat > np.sin(np.deg2rad(dlat)) else 180
+        delta_lon = lambda x: (x - center['lon'] + 180) % 360 - 180
+        inside = lambda LAT, LON: haversine(center['lat'],center['lon'],LAT,LON) < radius
+    else:
+        raise ValueError(f'Unknown units: {units}')
+
+    if lat.ndim == 1 and lon.ndim == 1:
+        ilat = np.flatnonzero(np.abs(lat.values-center['lat']) <= dlat)
+        ilon = np.flatnonzero(np.abs(delta_lon(lon.values)) <= dlon)
+
+        LON, LAT = np.meshgrid(lon.values[ilon],lat.values[ilat])
+
+        mask = np.zeros((lat.size,lon.size),dtype=bool)
+        mask[np.ix_(ilat,ilon)] = inside(LAT,LON)
+
+        return xr.DataArray(mask,
+                            coords=[(lat.dims[0],lat.values),(lon.dims[0],lon.values)],
+                            name='in_circle')
+    
+    LAT, LON = xr.broadcast(lat,lon)
+    box = (np.abs(LAT.values-center['lat']) <= dlat) & (np.abs(delta_lon(LON.values)) <= dlon)
+
+    mask = np.zeros(LAT.shape,dtype=bool)
+    mask[box] = inside(LAT.values[box],LON.values[box])
+
+    return LAT.copy(data=mask).rename('in_circle')
+
+
+
+def in_circles(dataset,centers,radius=0.2,units='degrees'):
+    '''
+    Locate the grid points within a given distance from many locations,
+    using one spatial index of the grid shared by all of them.
+
+            Parameters:
+                    dataset (xarray.Dataset or xarray.DataArray): Target dataset
+                    centers (pandas.DataFrame or dict): 'lat' and 'lon' of the locations,
+                                                        optionally a 'radius' for each of them
+                    radius (float): Radius used for locations without their own
+                    units (str): 'degrees' (the same polygon buffer as in_circle) or 'km' (great-circle distance)
+
+            Returns:
+                    offsets (numpy.ndarray): Matches of location i are at offsets[i]:offsets[i+1]
+                    indexes (dict): Indexes of the matching grid points along each grid dimension
+    '''
+
+    index = get_grid_index(dataset)
+
+    # Missing radii (NaN) get the default one
+    if 'radius' in centers:
+        own = np.asarray(centers['radius'],dtype=float)
+        radius = np.where(np.isnan(own),radius,own)
+
+    offsets, indexes = index.query_radius(centers['lat'],centers['lon'],radius,units=units)
+
+    return offsets, dict(zip(index.dims,indexes))
+
+
+
+def in_circle(dataarray,center,radius=0.2,mode='geopandas',units='degrees'):
+    '''
+    Select the grid points within a given distance from a location.
+
+            Parameters:
+                    dataarray (xarray.DataArray): Target data array
+                    center (dict): Location, with 'lat' and 'lon' keys
+                    radius (float): Radius of the circle (degrees)
+                    mode (str): 'geopandas' returns a GeoDataFrame with a row per point and time,
+                                'points' returns the data array stacked along a 'point' dimension,
+                                'mask' returns the data array masked outside the circle
+                    units (str): 'degrees' or 'km', only used by the 'points' and 'mask' modes
+
+            Returns:
+                    GeoDataFrame or xarray.DataArray (lazy if dataarray is dask-backed)
+    '''
+
+    # Fix coordinates if needed
+    da = fix_coordinates(dataarray)
+
+    if mode != 'geopandas':
+
+        mask = in_circle_mask(da,center,radius=radius,units=units)
+
+        if mode == 'points':
+            points = np.flatnonzero(mask.values)
+            return da.stack(point=mask.dims).isel(point=points)
+        elif mode == 'mask':
+            return da.where(mask)
+        else:
+            raise ValueError(f'Unknown mode: {mode}')
+
+    import geopandas as gpd
+
     p = gpd.points_from_xy([center['lon']],
                            [center['lat']],
                            crs="EPSG:4326")
@@ -1,16 +1,24 @@
+import hashlib
+import os
 import re
+import multiprocessing
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
 import numpy as np
 import pandas as pd
 
+import matplotlib
 from matplotlib import pyplot as plt
-import cartopy.crs as ccrs
-import cartopy.feature as cfeature
 
-import plotly.express as px
-import plotly.graph_objects as go
+# cartopy, shapely, plotly and scipy are imported by the functions that use them,
+# so that importing this module stays fast
 
-from grids import fix_coordinates
+from grids import fix_coordinates, crop, split_extent
+from cache import cached_reduction, source_identity
+from profiling import phase, record_bytes
 
 
 #############################
@@ -75,43 +83,144 @@ clevs_thresh = {10 : "cyan",
 
 
 
-def decorate_axes(ax,lons,lats):
+#############################
+# Background features
+#############################
+
+@lru_cache(maxsize=1)
+def _background_features():
+    '''
+    Feature and style overrides, by name.
+    '''
+    import cartopy.feature as cfeature
+
+    states_provinces = cfeature.NaturalEarthFeature(
+        category='cultural',
+        name='admin_1_states_provinces_lines',
+        scale='50m',
+        facecolor='none')
+
+    return {'states_provinces' : (states_provinces, {'edgecolor' : 'gray'}),
+            'coastline' : (cfeature.COASTLINE, {}),
+            'borders' : (cfeature.BORDERS, {}),
+            'lakes' : (cfeature.LAKES, {}),
+            'rivers' : (cfeature.RIVERS, {}),
+            }
+
+
+
+def _features():
+    '''
+    Returns background_features, building the defaults on first use.
+    Assigning or editing maps.background_features overrides them.
+    '''
+    if 'background_features' not in globals():
+        globals()['background_features'] = _background_features()
+
+    return globals()['background_features']
+
+
+
+def __getattr__(name):
+    # background_features and states_provinces are built on first use
+    if name == 'background_features':
+        return _features()
+    if name == 'states_provinces':
+        return _features()['states_provinces'][0]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+
+default_background = ('states_provinces','coastline','borders','lakes','rivers')
+
+
+
+def background_geometries(extent,projection,features=default_background):
+    '''
+    Returns the geometries of the background features, clipped
+    to the given extent and projected, with their drawing style.
+
+    Results are cached, so maps of the same domain and projection
+    do not clip and reproject the Natural Earth features again.
+
+            Parameters:
+                    extent (tuple): (lon_min, lon_max, lat_min, lat_max), longitudes
+                                    in -180..180, 0..360 or across the dateline
+                    projection (cartopy.crs.Projection): Target projection
+                    features (tuple): Names of the features (keys of background_features)
+
+            Returns:
+                    layers (list): (geometries, style) for each feature
+    '''
+    table = _features()
+
+    # Keyed on the features and styles, so that overrides are not hidden by the cache
+    layers = tuple((table[name][0],tuple(sorted(table[name][1].items()))) for name in features)
+
+    return _background_geometries(split_extent(extent),projection,layers)
+
+
+
+@lru_cache(maxsize=32)
+def _background_geometries(extents,projection,layers):
+    import shapely.geometry as sgeom
+
+    out = []
+    for feature, style in layers:
+
+        geoms = []
+        # Natural Earth geometries are in -180..180
+        for x0, x1, y0, y1 in extents:
+
+            # Small margin so that lines are not cut at the map border
+            clip = sgeom.box(x0,y0,x1,y1).buffer(1.0)
+
+            for geom in feature.intersecting_geometries((x0,x1,y0,y1)):
+                geom = geom.intersection(clip)
+                if not geom.is_empty:
+                    geoms.append(projection.project_geometry(geom,feature.crs))
+
+        out.append((tuple(geoms),dict(feature.kwargs,**dict(style))))
+
+    return out
+
+
+
+def decorate_axes(ax,lons,lats,features=default_background):
     '''
     Crop the given axes to the extent of the field to be plotted on it,
     add administrative boundaries, add geographic features
     and draw gridlines and labels.
 
             Parameters:
+                    ax (cartopy.mpl.geoaxes.GeoAxes): Target axes
+                    lons, lats (numpy.ndarray): Coordinates of the field
+                    features (tuple): Names of the background features to draw
                     
             Returns:
-                    
+                    ax (cartopy.mpl.geoaxes.GeoAxes): Decorated axes
     '''
+    import cartopy.crs as ccrs
 
     ax.set_extent((lons[0],lons[-1],lats[0],lats[-1]),crs=ccrs.PlateCarree())
       
     #ax.add_feature(cfeature.NaturalEarthFeature('physical', 'land', '50m', edgecolor='black', facecolor='wheat'))
     #ax.patch.set_visible(False)
 
-    states_provinces = cfeature.NaturalEarthFeature(
-        category='cultural',
-        name='admin_1_states_provinces_lines',
-        scale='50m',
-        facecolor='none')
-    
-    ax.add_feature(states_provinces, edgecolor='gray')
-    
-    ax.add_feature(cfeature.COASTLINE)
-    ax.add_feature(cfeature.BORDERS)
-    ax.add_feature(cfeature.LAKES)
-    ax.add_feature(cfeature.RIVERS)
-    #ax.add_feature(cfeature.LAND)
+    extent = (float(np.min(lons)),float(np.max(lons)),
+              float(np.min(lats)),float(np.max(lats)))
+
+    with phase('features'):
+        for geoms, style in background_geometries(extent,ax.projection,tuple(features)):
+            ax.add_geometries(geoms,crs=ax.projection,**style)
     
-    gl=ax.gridlines(draw_labels=True,
-                    linestyle='-',linewidth=1,color='gray',alpha=0.5)
-    gl.top_labels = False
-    gl.right_labels = False
-    gl.xlabel_style = {'size': 16}
-    gl.ylabel_style = {'size': 16}
+    with phase('gridlines'):
+        gl=ax.gridlines(draw_labels=True,
+                        linestyle='-',linewidth=1,color='gray',alpha=0.5)
+        gl.top_labels = False
+        gl.right_labels = False
+        gl.xlabel_style = {'size': 16}
+        gl.ylabel_style = {'size': 16}
 
     return ax
 
@@ -134,6 +243,7 @@ def custom_cbar(fig,ax,contour,label=''):
 
 
 def mark_location(ax,lat,lon):
+    import cartopy.crs as ccrs
     ax.plot(lon,lat,
             marker='*',markersize=20,markeredgewidth=2.5,
             markeredgecolor='black',markerfacecolor="None",
@@ -143,14 +253,19 @@ def mark_location(ax,lat,lon):
 
 
 
-def plot_prec(p,T,loc,ds_name=''):
+def plot_prec(p,T,loc,ds_name='',bbox=None,radius=None):
+    import cartopy.crs as ccrs
 
     prec = fix_coordinates(p)
+
+    # Read only the subdomain, if requested
+    prec = crop(prec,bbox=bbox,center=loc,radius=radius)
     
     # Extract variables
     lons = prec['longitude'].values[:]
     lats = prec['latitude'].values[:]
-    pr = prec.sel(time=T).values[:,:]
+    with phase('extract'):
+        pr = record_bytes('extract',prec.sel(time=T).values[:,:])
 
     TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a  %d %h %y  %H UTC')
     
@@ -162,12 +277,13 @@ def plot_prec(p,T,loc,ds_name=''):
 
     ax = decorate_axes(ax,lons,lats)
     
-    cplot_prec = ax.contourf(lons,lats,pr,
-                             levels=[float(c) for c in clevs_prec],
-                             transform=ccrs.PlateCarree(),
-                             #cmap=customColourMap,
-                             colors=[clevs_prec[c] for c in clevs_prec.keys()]
-                             )
+    with phase('contour'):
+        cplot_prec = ax.contourf(lons,lats,pr,
+                                 levels=[float(c) for c in clevs_prec],
+                                 transform=ccrs.PlateCarree(),
+                                 #cmap=customColourMap,
+                                 colors=[clevs_prec[c] for c in clevs_prec.keys()]
+                                 )
     
     cbar_prec = custom_cbar(fig,ax,cplot_prec,label='Accumulated precipitation (mm/6h)')
 
@@ -177,14 +293,19 @@ def plot_prec(p,T,loc,ds_name=''):
 
  
 
-def plot_return_period(return_period,T,loc,ds_name=''):
+def plot_return_period(return_period,T,loc,ds_name='',bbox=None,radius=None):
+    import cartopy.crs as ccrs
 
     rp = fix_coordinates(return_period)
 
+    # Read only the subdomain, if requested
+    rp = crop(rp,bbox=bbox,center=loc,radius=radius)
+
     # Extract variables
     lons = rp['longitude'].values[:]
     lats = rp['latitude'].values[:]
-    RP = rp.sel(time=T).values[:,:]
+    with phase('extract'):
+        RP = record_bytes('extract',rp.sel(time=T).values[:,:])
 
     TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a  %d %h %y  %H UTC')
     
@@ -196,12 +317,13 @@ def plot_return_period(return_period,T,loc,ds_name=''):
 
     ax = decorate_axes(ax,lons,lats)
     
-    cplot_rp = ax.contourf(lons,lats,RP,
-                           levels=[float(c) for c in clevs_rp],
-                           transform=ccrs.PlateCarree(),
-                           #cmap=customColourMap,
-                           colors=[clevs_rp[c] for c in clevs_rp.keys()]
-                           )
+    with phase('contour'):
+        cplot_rp = ax.contourf(lons,lats,RP,
+                               levels=[float(c) for c in clevs_rp],
+                               transform=ccrs.PlateCarree(),
+                               #cmap=customColourMap,
+                               colors=[clevs_rp[c] for c in clevs_rp.keys()]
+                               )
     
     cbar = fig.colorbar(cplot_rp,ax=ax,
                         orientation='horizontal',
@@ -219,10 +341,16 @@ def plot_return_period(return_period,T,loc,ds_name=''):
 
 
 
-def plot_prec_rp(p,return_period,T,loc,ds_name=''):
+def plot_prec_rp(p,return_period,T,loc,ds_name='',bbox=None,radius=None,regrid_method='nearest'):
+    from regrid import regrid
+    import cartopy.crs as ccrs
 
     prec = fix_coordinates(p)
     rp = fix_coordinates(return_period)
+
+    # Read only the subdomain, if requested
+    prec = crop(prec,bbox=bbox,center=loc,radius=radius)
+    rp = crop(rp,bbox=bbox,center=loc,radius=radius)
     
     #Extract variables
     lons = prec['longitude'].values[:]
@@ -231,11 +359,16 @@ def plot_prec_rp(p,return_period,T,loc,ds_name=''):
     lons_rp = rp['longitude'].values[:]
     lats_rp = rp['latitude'].values[:]
 
-    assert np.all(lons == lons_rp)
-    assert np.all(lats == lats_rp)
+    rp = rp.sel(time=T)
 
-    pr = prec.sel(time=T).values[:,:]
-    RP = rp.sel(time=T).values[:,:]
+    # Return period on another grid: regrid it to the precipitation grid
+    if not (np.array_equal(lons,lons_rp) and np.array_equal(lats,lats_rp)):
+        with phase('regrid'):
+            rp = regrid(rp,prec,method=regrid_method)
+
+    with phase('extract'):
+        pr = record_bytes('extract',prec.sel(time=T).values[:,:])
+        RP = record_bytes('extract',rp.values[:,:])
 
     TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a  %d %h %y  %H UTC')
 
@@ -248,12 +381,13 @@ def plot_prec_rp(p,return_period,T,loc,ds_name=''):
              transform=fig.transFigure,ha='right',fontsize=20,weight='bold')
     
     # Plot precipitation
-    cplot_prec = ax[0].contourf(lons,lats,pr,
-                                levels=[float(c) for c in clevs_prec],
-                                transform=ccrs.PlateCarree(),
-                                #cmap=customColourMap,
-                                colors=[clevs_prec[c] for c in clevs_prec.keys()]
-                                )
+    with phase('contour'):
+        cplot_prec = ax[0].contourf(lons,lats,pr,
+                                    levels=[float(c) for c in clevs_prec],
+                                    transform=ccrs.PlateCarree(),
+                                    #cmap=customColourMap,
+                                    colors=[clevs_prec[c] for c in clevs_prec.keys()]
+                                    )
     
     ax[0] = decorate_axes(ax[0],lons,lats)
 
@@ -262,12 +396,13 @@ def plot_prec_rp(p,return_period,T,loc,ds_name=''):
     ax[0] = mark_location(ax=ax[0],lon=loc['lon'],lat=loc['lat'])
 
     # Plot return period
-    cplot_rp= ax[1].contourf(lons,lats,RP,
-                             levels=[float(c) for c in clevs_rp],
-                             transform=ccrs.PlateCarree(),
-                             #cmap=customColourMap,
-                             colors=[clevs_rp[c] for c in clevs_rp.keys()]
-                             )
+    with phase('contour'):
+        cplot_rp= ax[1].contourf(lons,lats,RP,
+                                 levels=[float(c) for c in clevs_rp],
+                                 transform=ccrs.PlateCarree(),
+                                 #cmap=customColourMap,
+                                 colors=[clevs_rp[c] for c in clevs_rp.keys()]
+                                 )
     
     ax[1] = decorate_axes(ax[1],lons,lats)
 
@@ -279,20 +414,74 @@ def plot_prec_rp(p,return_period,T,loc,ds_name=''):
 
 
 
-def domain_map(grid,aoi,event):
+def decimate_points(grid,max_points):
+    '''
+    Reduce a table of grid points to about max_points, keeping
+    the first point of each cell of a coarser regular lat/lon grid.
+    '''
+    if len(grid) <= max_points:
+        return grid
+
+    lat = grid['latitude'].to_numpy()
+    lon = grid['longitude'].to_numpy()
+
+    # Cell size giving about max_points occupied cells
+    area = np.ptp(lat)*np.ptp(lon)
+    step = np.sqrt(area/max_points) if area > 0 else 1.
+
+    cells = np.floor(lat/step).astype(np.int64)*(2**32) + np.floor(lon/step).astype(np.int64)
+    _, first = np.unique(cells,return_index=True)
+
+    return grid.iloc[np.sort(first)]
+
+
+
+def domain_map(grid,aoi,event,max_points=None,mode='points'):
+    '''
+    Interactive map of the grid points, the area of interest and the event.
+
+            Parameters:
+                    grid (pandas.DataFrame): Grid points, with latitude, longitude and color
+                    aoi (shapely.geometry.Polygon): Area of interest
+                    event (dict): Event location, with 'lat' and 'lon' keys
+                    max_points (int): Decimate the grid points to about this number
+                    mode (str): 'points' draws the grid points, 'density' a density layer
+
+            Returns:
+                    fig (plotly.graph_objects.Figure)
+    '''
+    import plotly.graph_objects as go
     
     # Fix grid names if needed
     if 'lat' in grid and 'lon' in grid:
-        grid.rename(columns={'lat':'latitude','lon':'longitude'},inplace=True)
+        grid = grid.rename(columns={'lat':'latitude','lon':'longitude'})
+
+    if max_points is not None:
+        grid = decimate_points(grid,max_points)
+
+    # Typed arrays are sent as binary data instead of lists of numbers
+    lons = grid['longitude'].to_numpy(dtype=np.float32)
+    lats = grid['latitude'].to_numpy(dtype=np.float32)
 
     # Grid points
-    grid = go.Figure(go.Scattermapbox(
-        fill = None,
-        hoverinfo = 'skip',
-        lon = grid['longitude'],
-        lat = grid['latitude'],
-        marker = { 'size': 4, 'color': grid["color"] })#, 'symbol': ["cross"] })
-        ) 
+    if mode == 'points':
+        grid = go.Figure(go.Scattermapbox(
+            fill = None,
+            hoverinfo = 'skip',
+            lon = lons,
+            lat = lats,
+            marker = { 'size': 4, 'color': grid["color"].to_numpy() })#, 'symbol': ["cross"] })
+            ) 
+    elif mode == 'density':
+        grid = go.Figure(go.Densitymapbox(
+            hoverinfo = 'skip',
+            lon = lons,
+            lat = lats,
+            radius = 4,
+            showscale = False)
+            )
+    else:
+        raise ValueError(f'Unknown mode: {mode}')
                
     # Area of interest
 
@@ -330,14 +519,19 @@ def domain_map(grid,aoi,event):
 
 
 
-def plot_threshold(p,loc,ds_name=''):
+def plot_threshold(p,loc,ds_name='',bbox=None,radius=None):
+    import cartopy.crs as ccrs
 
     prec = fix_coordinates(p)
+
+    # Read only the subdomain, if requested
+    prec = crop(prec,bbox=bbox,center=loc,radius=radius)
     
     # Extract variables
     lons = prec['longitude'].values[:]
     lats = prec['latitude'].values[:]
-    pr = prec.values[:,:]
+    with phase('extract'):
+        pr = record_bytes('extract',prec.values[:,:])
 
     threshold = re.findall(r'\d+',prec.name)[0]
     
@@ -349,11 +543,12 @@ def plot_threshold(p,loc,ds_name=''):
     
     ax = decorate_axes(ax,lons,lats)
     
-    cplot_prec = ax.contourf(lons,lats,pr,
-                             levels=[float(c) for c in clevs_thresh.keys()],
-                             transform=ccrs.PlateCarree(),
-                             colors=[clevs_thresh[c] for c in clevs_thresh.keys()]
-                             )
+    with phase('contour'):
+        cplot_prec = ax.contourf(lons,lats,pr,
+                                 levels=[float(c) for c in clevs_thresh.keys()],
+                                 transform=ccrs.PlateCarree(),
+                                 colors=[clevs_thresh[c] for c in clevs_thresh.keys()]
+                                 )
     
     cbar = custom_cbar(fig,ax,cplot_prec,label='Accumulated precipitation (mm/6h)')
     
@@ -363,16 +558,28 @@ def plot_threshold(p,loc,ds_name=''):
 
 
 
-def plot_min_max_prec(p,ds_name=''):
+def plot_min_max_prec(p,ds_name='',cache_dir=None,bbox=None):
+    import cartopy.crs as ccrs
 
     prec = fix_coordinates(p)
+
+    # Read only the subdomain, if requested
+    prec = crop(prec,bbox=bbox)
     
     #Extract variables
     lons = prec['longitude'].values[:]
     lats = prec['latitude'].values[:]
 
-    prec_min = prec.min(dim='time').values[:,:]
-    prec_max = prec.max(dim='time').values[:,:]
+    # Read min and max from the derived fields cache if requested
+    with phase('extract'):
+        if cache_dir is not None:
+            prec_min = cached_reduction(prec,'min',dim='time',cache_dir=cache_dir).values[:,:]
+            prec_max = cached_reduction(prec,'max',dim='time',cache_dir=cache_dir).values[:,:]
+        else:
+            prec_min = prec.min(dim='time').values[:,:]
+            prec_max = prec.max(dim='time').values[:,:]
+        record_bytes('extract',prec_min)
+        record_bytes('extract',prec_max)
 
     # Make plots
     fig, ax = plt.subplots(1,2,subplot_kw={'projection':ccrs.PlateCarree()},figsize=(18,8))
@@ -383,21 +590,23 @@ def plot_min_max_prec(p,ds_name=''):
     #          transform=fig.transFigure,ha='right',fontsize=20,weight='bold')
 
     # Plot min
-    cplot_prec_min = ax[0].contourf(lons,lats,prec_min,
-                                    levels=[float(c) for c in clevs_prec],
-                                    transform=ccrs.PlateCarree(),
-                                    colors=[clevs_prec[c] for c in clevs_prec.keys()]
-                                    )
+    with phase('contour'):
+        cplot_prec_min = ax[0].contourf(lons,lats,prec_min,
+                                        levels=[float(c) for c in clevs_prec],
+                                        transform=ccrs.PlateCarree(),
+                                        colors=[clevs_prec[c] for c in clevs_prec.keys()]
+                                        )
     
     ax[0] = decorate_axes(ax[0],lons,lats)
     cbar_prec = custom_cbar(fig,ax[0],cplot_prec_min,label='Min accumulated precipitation (mm/h)')
 
     # Plot max
-    cplot_prec_max = ax[1].contourf(lons,lats,prec_max,
-                                    levels=[float(c) for c in clevs_prec],
-                                    transform=ccrs.PlateCarree(),
-                                    colors=[clevs_prec[c] for c in clevs_prec.keys()]
-                                    )
+    with phase('contour'):
+        cplot_prec_max = ax[1].contourf(lons,lats,prec_max,
+                                        levels=[float(c) for c in clevs_prec],
+                                        transform=ccrs.PlateCarree(),
+                                        colors=[clevs_prec[c] for c in clevs_prec.keys()]
+                                        )
     
     ax[1] = decorate_axes(ax[1],lons,lats)
     cbar_prec = custom_cbar(fig,ax[1],cplot_prec_max,label='Max accumulated precipitation (mm/h)')
@@ -406,6 +615,336 @@ def plot_min_max_prec(p,ds_name=''):
 
 
 
+#############################
+# Map sessions
+#############################
+
+class MapSession:
+    '''
+    Figure, decorated axes and colorbar of a map, built once for a domain
+    and a set of contour levels and reused for a sequence of fields.
+    Each update only replaces the contours and the time stamp.
+
+            Parameters:
+                    lons, lats (numpy.ndarray): Coordinates of the fields
+                    clevs (dict): Contour levels and colors (clevs_prec, clevs_rp, clevs_thresh)
+                    levels (list or int): Contour levels, used with cmap if clevs is None
+                                          (fixed by the first field if not a list)
+                    cmap (str): Colormap, used if clevs is None
+                    filled (bool): Filled contours with colorbar, or dashed lines with labels
+                    color (str): Color of the lines, if not filled
+                    alpha (float): Transparency of the contours
+                    label (str): Colorbar label
+                    ds_name (str): Dataset name, shown in the left title
+                    loc (dict): Location to mark, with 'lat' and 'lon' keys
+                    figsize (tuple): Figure size
+    '''
+
+    def __init__(self,lons,lats,clevs=None,levels=None,cmap=None,
+                 filled=True,color='black',alpha=None,
+                 label='',ds_name='',loc=None,figsize=(10,10)):
+        import cartopy.crs as ccrs
+
+        self.lons = lons
+        self.lats = lats
+        self.filled = filled
+        self.label = label
+
+        if clevs is not None:
+            self.levels = [float(c) for c in clevs]
+            self.style = {'colors' : [clevs[c] for c in clevs.keys()]}
+        elif filled:
+            self.levels = levels
+            self.style = {'cmap' : cmap}
+        else:
+            self.levels = 12 if levels is None else levels
+            self.style = {'colors' : color,'linewidths' : 1,'linestyles' : 'dashed'}
+
+        if alpha is not None:
+            self.style['alpha'] = alpha
+
+        self.fig, self.ax = plt.subplots(subplot_kw={'projection':ccrs.PlateCarree()},figsize=figsize)
+
+        self.ax.set_title(f'{ds_name}',loc='left',fontsize=20,weight='bold',pad=2)
+        self.title = self.ax.set_title('',loc='right',fontsize=20,weight='bold',pad=2)
+
+        self.ax = decorate_axes(self.ax,lons,lats)
+
+        if loc is not None:
+            self.ax = mark_location(ax=self.ax,lon=loc['lon'],lat=loc['lat'])
+
+        self.contour = None
+        self.cbar = None
+
+
+    def _clear(self):
+
+        if self.contour is None:
+            return
+        
+        try:
+            self.contour.remove()
+        except AttributeError:
+            # matplotlib < 3.8: contour sets are not artists
+            for c in self.contour.collections:
+                c.remove()
+            for t in self.contour.labelTexts:
+                t.remove()
+
+        self.contour = None
+
+
+    def update(self,field,T=None,title=None):
+        '''
+        Draw a new field, replacing the previous one.
+
+                Parameters:
+                        field (xarray.DataArray or numpy.ndarray): Field to draw,
+                                selected at time T if it has a time dimension
+                        T (xarray.DataArray): Time of the field, shown in the right title
+                        title (str): Right title, instead of the time stamp
+
+                Returns:
+                        fig (matplotlib.figure.Figure): The session figure
+        '''
+        import cartopy.crs as ccrs
+
+        if T is not None and 'time' in getattr(field,'dims',()):
+            field = field.sel(time=T)
+
+        with phase('extract'):
+            values = record_bytes('extract',np.asarray(field))
+
+        self._clear()
+
+        if self.filled:
+            with phase('contour'):
+                self.contour = self.ax.contourf(self.lons,self.lats,values,
+                                                levels=self.levels,
+                                                transform=ccrs.PlateCarree(),
+                                                **self.style)
+            
+            # Levels and colorbar are fixed by the first field
+            if self.cbar is None:
+                self.levels = list(self.contour.levels)
+                self.cbar = custom_cbar(self.fig,self.ax,self.contour,label=self.label)
+        else:
+            with phase('contour'):
+                self.contour = self.ax.contour(self.lons,self.lats,values,
+                                               levels=self.levels,
+                                               transform=ccrs.PlateCarree(),
+                                               **self.style)
+            self.contour.clabel(fmt='%d')
+
+        if title is None and T is not None:
+            title = pd.to_datetime(str(T.values)).strftime('%a  %d %h %y  %H UTC')
+        if title is not None:
+            self.title.set_text(title)
+
+        return self.fig
+
+
+    def savefig(self,path,dpi=100):
+        with phase('encode'):
+            self.fig.savefig(path,dpi=dpi)
+
+
+    def close(self):
+        plt.close(self.fig)
+
+
+
+#############################
+# Batch rendering
+#############################
+
+# Data arrays shared by the frames rendered in a worker process
+_frame_arrays = None
+
+
+
+def _init_frame_worker(arrays):
+    global _frame_arrays
+
+    matplotlib.use('Agg')
+    _frame_arrays = arrays
+
+
+
+def frame_path(outdir,T,prefix='frame'):
+    '''
+    Returns the path of the PNG file of the frame at time T.
+    '''
+    stamp = pd.to_datetime(str(T.values)).strftime('%Y%m%d%H%M')
+
+    return os.path.join(outdir,f'{prefix}_{stamp}.png')
+
+
+
+def _render_frame(plot_func,T,path,dpi,kwargs,arrays=None):
+
+    if arrays is None:
+        arrays = _frame_arrays
+
+    fig = plot_func(*arrays,T,**kwargs)
+    with phase('encode'):
+        fig.savefig(path,dpi=dpi)
+    plt.close(fig)
+
+    return path
+
+
+
+def select_times(dataarray,times=None):
+    '''
+    Returns the time coordinate of the data array, restricted to the given
+    times (list of times, slice or None for all the time steps).
+    '''
+    time = fix_coordinates(dataarray)['time']
+
+    if times is None:
+        return time
+    
+    return time.sel(time=times)
+
+
+
+def render_frames(plot_func,arrays,outdir,times=None,processes=None,
+                  prefix='frame',dpi=100,skip_existing=False,**kwargs):
+    '''
+    Render a map for each time step and write it to a PNG file,
+    distributing the frames to a pool of worker processes.
+
+            Parameters:
+                    plot_func (function): Map function called as plot_func(*arrays,T,**kwargs),
+                                          e.g. plot_prec, plot_return_period or plot_prec_rp
+                    arrays (tuple): Data arrays passed to plot_func
+                    outdir (str): Output directory
+                    times (list or slice): Times to render, all the time steps of arrays[0] if None
+                    processes (int): Number of worker processes (all the CPUs if None,
+                                     rendering in the current process if 1)
+                    prefix (str): Prefix of the file names
+                    dpi (int): Resolution of the images
+                    skip_existing (bool): Do not render frames whose file already exists
+                    **kwargs: Other arguments passed to plot_func (loc, ds_name, ...)
+
+            Returns:
+                    paths (list): Paths of the frames, in time order
+    '''
+
+    if not isinstance(arrays,(tuple,list)):
+        arrays = (arrays,)
+    arrays = tuple(arrays)
+
+    os.makedirs(outdir,exist_ok=True)
+
+    frames = [(T,frame_path(outdir,T,prefix)) for T in select_times(arrays[0],times)]
+    todo = [(T,path) for T, path in frames if not (skip_existing and os.path.exists(path))]
+
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1,min(processes,len(todo)))
+
+    if processes == 1:
+        for T, path in todo:
+            _render_frame(plot_func,T,path,dpi,kwargs,arrays=arrays)
+    else:
+        # Spawned workers do not inherit open files or dask threads
+        with ProcessPoolExecutor(max_workers=processes,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_frame_worker,
+                                 initargs=(arrays,)) as pool:
+            futures = [pool.submit(_render_frame,plot_func,T,path,dpi,kwargs) for T, path in todo]
+            for future in futures:
+                future.result()
+
+    return [path for _, path in frames]
+
+
+
+def frames_key(plot_func,arrays,dpi=100,**kwargs):
+    '''
+    Returns a hash of what the frames of an animation depend on:
+    map function, its arguments, resolution and source of the data.
+    '''
+    if not isinstance(arrays,(tuple,list)):
+        arrays = (arrays,)
+
+    h = hashlib.sha1()
+    h.update(f'{plot_func.__module__}.{plot_func.__qualname__}|{dpi}'.encode())
+    h.update(repr(sorted(kwargs.items())).encode())
+    for a in arrays:
+        h.update(source_identity(a).encode())
+
+    return h.hexdigest()[:16]
+
+
+
+def _pipe_frames(cmd,frames):
+    '''
+    Stream PNG frames, one at a time, to an ffmpeg command.
+    '''
+    with subprocess.Popen(cmd,stdin=subprocess.PIPE) as ffmpeg:
+        for frame in frames:
+            with open(frame,'rb') as f:
+                ffmpeg.stdin.write(f.read())
+        ffmpeg.stdin.close()
+
+    if ffmpeg.returncode != 0:
+        raise RuntimeError(f'ffmpeg failed with exit code {ffmpeg.returncode}')
+
+
+
+def animate(plot_func,arrays,path,times=None,fps=4,frame_dir=None,
+            processes=None,prefix='frame',dpi=100,**kwargs):
+    '''
+    Export an animation of a map function (GIF or MP4, from the extension of path).
+
+    Frames are rendered by render_frames into a subdirectory of frame_dir
+    keyed by frames_key, skipping frames already there from an earlier run
+    with the same function, arguments and data. Their PNG files are streamed
+    one at a time to ffmpeg, so frames are never all held in memory (GIFs
+    take two passes: palette, then encoding).
+
+            Parameters:
+                    plot_func (function): Map function called as plot_func(*arrays,T,**kwargs),
+                                          e.g. plot_prec, plot_prec_rp or predictors_maps.contour_var
+                    arrays (tuple): Data arrays passed to plot_func
+                    path (str): Output file (.gif or .mp4)
+                    times (list or slice): Times to render, all the time steps if None
+                    fps (int): Frames per second
+                    frame_dir (str): Frame cache directory, a temporary one if None
+                    processes (int): Number of processes used to render the frames
+                    prefix (str): Prefix of the frame file names
+                    dpi (int): Resolution of the frames
+                    **kwargs: Other arguments passed to plot_func
+
+            Returns:
+                    path (str): Path of the animation
+    '''
+
+    tmp = tempfile.TemporaryDirectory()
+    if frame_dir is None:
+        frame_dir = tmp.name
+
+    frame_dir = os.path.join(frame_dir,frames_key(plot_func,arrays,dpi=dpi,**kwargs))
+
+    try:
+        frames = render_frames(plot_func,arrays,frame_dir,times=times,processes=processes,
+                               prefix=prefix,dpi=dpi,skip_existing=True,**kwargs)
 
+        ffmpeg = [matplotlib.rcParams['animation.ffmpeg_path'],'-y','-loglevel','error',
+                  '-f','image2pipe','-framerate',str(fps),'-c:v','png','-i','-']
 
+        if path.lower().endswith('.gif'):
+            # palettegen only keeps a colour histogram, paletteuse streams the frames
+            palette = os.path.join(tmp.name,'palette.png')
+            _pipe_frames([*ffmpeg,'-vf','palettegen',palette],frames)
+            _pipe_frames([*ffmpeg,'-i',palette,'-lavfi','[0:v][1:v]paletteuse',path],frames)
+        else:
+            _pipe_frames([*ffmpeg,'-vf','pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                          '-c:v','libx264','-pix_fmt','yuv420p',path],frames)
+    finally:
+        tmp.cleanup()
 
+    return path
@@ -1,9 +1,14 @@
 import re
 from itertools import cycle
 
+import numpy as np
+import xarray as xr
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 
 from grids import closest_gridpoint_indexes, fix_coordinates
+from profiling import phase, record_bytes
 
 
 ##################################
@@ -17,7 +22,47 @@ colors = cycle(color_list)
 
 
 
+def _style_spaghetti_axes(ax):
+
+    # Precipitation
+    #ax[0].set_ylim(bottom=-1)
+    ax[0].margins(y=0.05)
+
+    ax[0].set_title('Accumulated precipitation',
+                    fontsize=16,fontweight='bold',pad=5,loc='left')
+
+    ax[0].tick_params(axis='x', which='both', labelbottom=False)
+    ax[0].xaxis.set_major_locator(plt.MaxNLocator(12))
+
+    ax[0].tick_params(axis='y', which='major', labelsize=16)
+    ax[0].set_ylabel('mm/6h',size=16,weight='bold',labelpad=10)
+
+    ax[0].grid(True,axis='both')
+
+    # Return period
+    #ax[1].set_ylim(bottom=0.95)
+    ax[1].margins(y=0.05)
+
+    ax[1].set_title('Return period',
+                    fontsize=16,fontweight='bold',pad=5,loc='left')
+
+    #xlab = pd.to_datetime(str(ts_rp['time'])).strftime('%d %h %y')    
+    #ax[1].set_xticks(ts_rp['time'],labels=xlab)
+    
+    ax[1].tick_params(axis='x', labelrotation=60, labelsize=14)
+    ax[1].xaxis.set_major_locator(plt.MaxNLocator(12))
+
+    ax[1].tick_params(axis='y', which='major', labelsize=16)
+    ax[1].set_ylabel('years',size=16,weight='bold',labelpad=10)
+
+    ax[1].grid(True,axis='both')
+
+    return ax
+
+
+
 def prec_rp_spaghetti_plot(precipitation,return_period,poi,main_loc,event_time,ds_name=''):
+    import dask
 
     # Fix coordinates names if needed
     prec = fix_coordinates(precipitation)
@@ -32,6 +77,32 @@ def prec_rp_spaghetti_plot(precipitation,return_period,poi,main_loc,event_time,d
     main_lon = main_ts['longitude'].values
     main_lat = main_ts['latitude'].values
 
+    # Extract the time series of all the points at once
+    points = poi[['latitude','longitude']].drop_duplicates()
+    LT = xr.DataArray(points['latitude'].values,dims='point')
+    LN = xr.DataArray(points['longitude'].values,dims='point')
+
+    with phase('extract'):
+        ts_pr6, ts_rp = dask.compute(prec.sel(longitude=LN,latitude=LT).transpose('point','time'),
+                                     rp.sel(longitude=LN,latitude=LT).transpose('point','time'))
+        record_bytes('extract',ts_pr6)
+        record_bytes('extract',ts_rp)
+
+    # Filter grid points with a lot of Nan
+    null = ts_rp.isnull().sum(dim='time').values
+    keep = null < ts_rp.sizes['time']/4
+    for LNi, LTi in zip(LN.values[~keep],LT.values[~keep]):
+        print(f'Too many Nan at ({LNi},{LTi})')
+
+    # Manual exclusion of flawed grid points
+    #keep &= ~((LT.values==41.74986002750993) & (LN.values==-0.9501396052110067))
+
+    main = (LN.values == main_lon) & (LT.values == main_lat)
+
+    # Main point drawn last, on top of the others
+    order = np.concatenate((np.flatnonzero(keep & ~main),np.flatnonzero(keep & main)))
+    lwidth = np.where(main[order],2,0.75)
+
     # make plots
     fig, ax = plt.subplots(2,1,figsize=(14,12))
 
@@ -43,78 +114,26 @@ def prec_rp_spaghetti_plot(precipitation,return_period,poi,main_loc,event_time,d
     # Vertical line at event time
     ax[0].axvline(event_time, color='red',linewidth=2,linestyle='--')
     ax[1].axvline(event_time, color='red',linewidth=2,linestyle='--')
-    
-    for _,row in poi.iterrows():
-        LN = row['longitude']
-        LT = row['latitude']
-        #print(f'lat: {LT}, lon: {LN}')
-
-        if (LN == main_lon) and (LT == main_lat):
-            lwidth = 2
-            cprec = 'navy'
-            crp = 'darkorchid'
-        else:
-            lwidth = 0.75
-            cprec = 'deepskyblue'
-            crp = 'violet'
-    
-        # Manual exclusion of flawed grid points
-        #if (LT==41.74986002750993 and LN==-0.9501396052110067):
-        #    continue
-        
-        ts_pr6 = prec.sel(longitude=LN,latitude=LT)
-        ts_rp = rp.sel(longitude=LN,latitude=LT)
-        
-        # Filter grid points with a lot of Nan
-        null = ts_rp.isnull().values
-        if len(null[null==True]) >= len(null)/4:
-            print(f'Too many Nan at ({LN},{LT})')
-            continue
-        
-        # Precipitation
-        ax[0].plot(ts_pr6['time'],ts_pr6,
-                   label=f"{ts_pr6['longitude'].values},{ts_pr6['latitude'].values}",
-                   color=cprec,
-                   linewidth=lwidth)
-        
-        #ax[0].set_ylim(bottom=-1)
-        ax[0].margins(y=0.05)
-
-        ax[0].set_title('Accumulated precipitation',
-                        fontsize=16,fontweight='bold',pad=5,loc='left')
-
-        ax[0].tick_params(axis='x', which='both', labelbottom=False)
-        ax[0].xaxis.set_major_locator(plt.MaxNLocator(12))
-
-        ax[0].tick_params(axis='y', which='major', labelsize=16)
-        ax[0].set_ylabel('mm/6h',size=16,weight='bold',labelpad=10)
 
-        ax[0].grid(True,axis='both')
+    # One collection of lines per panel, each series against its own time
+    for i, (ts, cmain, cother) in enumerate(((ts_pr6,'navy','deepskyblue'),
+                                             (ts_rp,'darkorchid','violet'))):
         
-        # Return period
-        ax[1].plot(ts_rp['time'],ts_rp,
-                   label=f"{ts_pr6['longitude'].values},{ts_pr6['latitude'].values}",
-                   color=crp,
-                   linewidth=lwidth)
-        
-        #ax[1].set_ylim(bottom=0.95)
-        ax[1].margins(y=0.05)
-
-        ax[1].set_title('Return period',
-                        fontsize=16,fontweight='bold',pad=5,loc='left')
+        t = mdates.date2num(ts['time'].values)
+        y = ts.values[order]
+        segments = np.stack((np.broadcast_to(t,y.shape),y),axis=-1)
 
-        #xlab = pd.to_datetime(str(ts_rp['time'])).strftime('%d %h %y')    
-        #ax[1].set_xticks(ts_rp['time'],labels=xlab)
-        
-        ax[1].tick_params(axis='x', labelrotation=60, labelsize=14)
-        ax[1].xaxis.set_major_locator(plt.MaxNLocator(12))
+        with phase('render'):
+            lines = LineCollection(segments,
+                                   colors=np.where(main[order],cmain,cother),
+                                   linewidths=lwidth)
+            ax[i].add_collection(lines)
+            ax[i].xaxis_date()
+            ax[i].autoscale_view()
 
-        ax[1].tick_params(axis='y', which='major', labelsize=16)
-        ax[1].set_ylabel('years',size=16,weight='bold',labelpad=10)
+    ax = _style_spaghetti_axes(ax)
 
-        ax[1].grid(True,axis='both')
-
-        # ax[1].legend()
+    # ax[1].legend()
 
     return fig
 
@@ -153,18 +172,22 @@ def scatter_rp_prec(dataset,main_loc,points,ds_name=''):
     
     ax.grid(True,axis='both')
 
-    for idx,_ in points.reset_index().iterrows():
-        #print(idx)
-        lon = points.iloc[idx].loc['longitude']
-        lat = points.iloc[idx].loc['latitude']
-        
-        COLR = next(colors)
+    # Return period thresholds, parsed once
+    rp_levs = [rp for rp in ds if rp.startswith('rp')]
+    years = np.array([float(re.findall(r'\d+', rp)[0]) for rp in rp_levs])
 
-        rp_levs = [rp for rp in ds if rp.startswith('rp')]
-        
-        for rp in rp_levs:
-            years = float(re.findall(r'\d+', rp)[0])
-            prec  = ds[f'{rp}'].sel(latitude=lat,longitude=lon).values
-            ax.scatter(prec,years,c=COLR,marker='x',s=70)
+    # Extract all the thresholds at all the points at once: (points x return periods)
+    pts = points[['latitude','longitude']].drop_duplicates()
+    lat = xr.DataArray(pts['latitude'].values,dims='point')
+    lon = xr.DataArray(pts['longitude'].values,dims='point')
+
+    with phase('extract'):
+        prec = record_bytes('extract',ds[rp_levs].sel(latitude=lat,longitude=lon).to_array(dim='rp').transpose('point','rp').values)
+
+    COLR = [next(colors) for _ in range(len(pts))]
+
+    with phase('render'):
+        ax.scatter(prec.ravel(),np.tile(years,len(pts)),
+                   c=np.repeat(COLR,len(years)),marker='x',s=70)
             
-    return fig
\ No newline at end of file
+    return fig
@@ -1,8 +1,11 @@
+import numpy as np
 import pandas as pd
 from matplotlib import pyplot as plt
-import cartopy.crs as ccrs
 
-from maps import decorate_axes, custom_cbar
+from maps import decorate_axes, custom_cbar, MapSession
+from cache import cached
+from grids import crop
+from profiling import phase, record_bytes
 
 
 
@@ -29,65 +32,123 @@ cline_col = {'air_pressure_at_mean_sea_level' : 'black',
 
 
 
-def convert_variable(var):
+# Unit conversions by standard name: converted = var*scale + offset
+conversions = {'air_pressure_at_mean_sea_level' : {'name' : 'Mean sea level pressure',
+                                                   'units' : 'hPa',
+                                                   'scale' : 0.01,
+                                                   'offset' : 0.},
+               'air_temperature' : {'name' : 'Temperature',
+                                    'units' : 'C',
+                                    'scale' : 1.,
+                                    'offset' : -273.15},
+               'eastward_wind' : {'name' : 'U component of wind',
+                                  'units' : 'm/s',
+                                  'scale' : 1.,
+                                  'offset' : 0.},
+               'geopotential' : {'name' : 'Geopotential height',
+                                 'units' : 'dam',
+                                 'scale' : 1/(9.80665*10),
+                                 'offset' : 0.},
+               'lagrangian_tendency_of_air_pressure' : {'name' : 'Vertical velocity',
+                                                        'units' : 'Pa/s',
+                                                        'scale' : 1.,
+                                                        'offset' : 0.},
+               'northward_wind' : {'name' : 'V component of wind',
+                                   'units' : 'm/s',
+                                   'scale' : 1.,
+                                   'offset' : 0.},
+               'specific_humidity' : {'name' : 'Specific humidity',
+                                      'units' : 'g/Kg',
+                                      'scale' : 1000.,
+                                      'offset' : 0.},
+               }
 
-    #print(var.standard_name)
-    #print(var.units)
-    #print(var)
 
-    if var.standard_name == 'air_pressure_at_mean_sea_level':
-        var_out = var/100
-        var_name = 'Mean sea level pressure'
-        var_units = 'hPa'
 
-    elif var.standard_name == 'air_temperature':
-        var_out = var - 273.15
-        var_name = 'Temperature'
-        var_units = 'C'
+def apply_conversion(var,scale=1.,offset=0.,dtype=None,inplace=False):
+    """
+    Returns var*scale + offset, lazily for dask-backed variables.
+    dtype (e.g. 'float32') casts before converting, and inplace
+    overwrites the data of in-memory float variables instead of copying them.
+    """
 
-    elif var.standard_name == 'eastward_wind':
-        var_out = var
-        var_name = 'U component of wind'
-        var_units = 'm/s'
+    if dtype is not None:
+        var = var.astype(dtype,copy=False)
 
-    elif var.standard_name == 'geopotential':
-        var_out = (var / 9.80665)/10
-        var_name = 'Geopotential height'
-        var_units = 'dam'
+    if scale == 1 and offset == 0:
+        return var
 
-    elif var.standard_name == 'lagrangian_tendency_of_air_pressure':
-        var_out = var
-        var_name = 'Vertical velocity'
-        var_units = 'Pa/s'
+    if inplace and var.chunks is None and np.issubdtype(var.dtype,np.floating):
+        data = var.values
+        if scale != 1:
+            np.multiply(data,scale,out=data)
+        if offset != 0:
+            np.add(data,offset,out=data)
+        return var
 
-    elif var.standard_name == 'northward_wind':
-        var_out = var
-        var_name = 'V component of wind'
-        var_units = 'm/s'
+    var_out = var*scale if scale != 1 else var
+    if offset != 0:
+        var_out = var_out + offset
 
-    elif var.standard_name == 'specific_humidity':
-        var_out = var / 1000
-        var_name = 'Specific humidity'
-        var_units = 'g/Kg'
+    return var_out
 
-    else:
+
+
+def convert_variable(var,dtype=None,inplace=False,cache_dir=None):
+
+    conv = conversions.get(var.attrs.get('standard_name'))
+
+    if conv is None:
         print('Variable not in list!')
-        var_out = var
-        var_name = ''
-        var_units = ''
+        return var, '', ''
+
+    var_name = conv['name']
+    var_units = conv['units']
+
+    # Already converted (e.g. by convert_dataset)
+    if var.attrs.get('units') == var_units:
+        return var, var_name, var_units
+
+    kwargs = {'scale' : conv['scale'],'offset' : conv['offset'],'dtype' : dtype}
+
+    # Converted data from the derived fields cache
+    if cache_dir is not None:
+        var_out = cached(apply_conversion,var,cache_dir=cache_dir,**kwargs)
+    else:
+        var_out = apply_conversion(var,inplace=inplace,**kwargs)
+
+    # Identity conversions return the input: do not relabel the caller's variable
+    if var_out is var and not inplace:
+        var_out = var.copy(deep=False)
+
+    var_out.attrs = dict(var.attrs,long_name=var_name,units=var_units)
     
     return var_out, var_name, var_units
 
 
 
+def convert_dataset(ds,dtype=None,inplace=False):
+    """
+    Convert all the variables of a Dataset with a known standard name
+    """
+
+    converted = {}
+    for name, var in ds.data_vars.items():
+        if var.attrs.get('standard_name') in conversions:
+            converted[name], _, _ = convert_variable(var,dtype=dtype,inplace=inplace)
+
+    return ds.assign(converted)
+
+
+
 def get_colors(var):
     """
     Get colors for contours
     """
 
     if hasattr(var,"standard_name"):
-        cfill = cfill_cmaps[var.standar_name]
-        cline = cline_col[var.standar_name]
+        cfill = cfill_cmaps.get(var.standard_name,'viridis')
+        cline = cline_col.get(var.standard_name,'black')
 
     elif hasattr(var,"long_name"):
         cfill = 'viridis'
@@ -100,13 +161,14 @@ def get_colors(var):
 
 
 
-def convert_get_attr(var):
+def convert_get_attr(var,dtype=None,inplace=False,cache_dir=None):
     """
     Convert the variable as needed
     """
 
     if hasattr(var,"standard_name"):
-        var_out, var_name, var_units = convert_variable(var)
+        var_out, var_name, var_units = convert_variable(var,dtype=dtype,inplace=inplace,
+                                                        cache_dir=cache_dir)
 
     elif hasattr(var,"long_name"):
         var_out = var
@@ -121,7 +183,60 @@ def convert_get_attr(var):
 
 
 
-def contour_var(var,T,lev=None,filled=True,ds_name=''):
+def _select_level(var,T,lev):
+    """
+    Select var at time T and pressure level lev (hPa, None or 'sfc' for surface)
+    """
+
+    if lev not in [None, 'sfc']:
+        return var.sel(time=T,plev=lev*100), f'{lev} hPa'
+
+    return var.sel(time=T), 'sfc'
+
+
+
+def _draw_filled(fig,ax,lons,lats,VAR,cmap,label=''):
+    import cartopy.crs as ccrs
+
+    with phase('contour'):
+        cfplot = ax.contourf(lons,lats,VAR,
+                             #levels=[float(c) for c in clevs_prec],
+                             alpha=0.7,
+                             transform=ccrs.PlateCarree(),
+                             cmap=cmap,
+                             #colors=[clevs_prec[c] for c in clevs_prec.keys()]
+                             )
+
+    cbar = custom_cbar(fig,ax,cfplot,label=label)
+
+    return cfplot
+
+
+
+def _draw_lines(ax,lons,lats,VAR,color):
+    import cartopy.crs as ccrs
+
+    with phase('contour'):
+        cplot = ax.contour(lons,lats,VAR,
+                           levels=12,
+                           colors=color,
+                           alpha=0.75,
+                           linewidths=1,
+                           linestyles='dashed',
+                           transform=ccrs.PlateCarree(),
+                           )
+
+    cplot.clabel(fmt='%d')
+
+    return cplot
+
+
+
+def contour_var(var,T,lev=None,filled=True,ds_name='',bbox=None,center=None,radius=None):
+    import cartopy.crs as ccrs
+
+    # Read only the subdomain, if requested
+    var = crop(var,bbox=bbox,center=center,radius=radius)
 
     # Get time stamp
     TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a %d %h %y  %H UTC')
@@ -131,14 +246,11 @@ def contour_var(var,T,lev=None,filled=True,ds_name=''):
     lats = var['latitude'].values[:]
 
     #Extract variable, convert plev in hPa
-    if lev not in [None, 'sfc']:
-        LEV = lev*100
-        LEV_descr = f'{lev} hPa'
-        VAR, var_name, var_units = convert_get_attr(var.sel(time=T,plev=LEV))
-    else:
-        LEV = 'sfc'
-        LEV_descr = LEV
-        VAR, var_name, var_units = convert_get_attr(var.sel(time=T))
+    VAR, LEV_descr = _select_level(var,T,lev)
+    VAR, var_name, var_units = convert_get_attr(VAR)
+
+    with phase('extract'):
+        VAR = record_bytes('extract',VAR.load())
     
     # Make plot
     fig, ax = plt.subplots(subplot_kw={'projection':ccrs.PlateCarree()},figsize=(8,8))
@@ -160,15 +272,7 @@ def contour_var(var,T,lev=None,filled=True,ds_name=''):
             f'{ds_name}',
             fontsize='xx-large',transform=ax.transAxes,weight='bold')
         
-        cfplot = ax.contourf(lons,lats,VAR,
-                             #levels=[float(c) for c in clevs_prec],
-                             alpha=0.7,
-                             transform=ccrs.PlateCarree(),
-                             cmap=CMAP,
-                             #colors=[clevs_prec[c] for c in clevs_prec.keys()]
-                             )
-        
-        cbar = custom_cbar(fig,ax,cfplot,label=f'{var_name} ({var_units})')
+        cfplot = _draw_filled(fig,ax,lons,lats,VAR,CMAP,label=f'{var_name} ({var_units})')
 
     else:
 
@@ -183,19 +287,148 @@ def contour_var(var,T,lev=None,filled=True,ds_name=''):
                 fontsize='large',transform=ax.transAxes,weight='bold')
         
 
-        cplot = ax.contour(lons,lats,VAR,
-                           levels=12,
-                           colors=cline_color,
-                           alpha=0.75,
-                           linewidths=1,
-                           linestyles='dashed',
-                           transform=ccrs.PlateCarree(),
-                           )
-        
-        cplot.clabel(fmt='%d')
+        cplot = _draw_lines(ax,lons,lats,VAR,cline_color)
 
     return fig
 
 
- 
- 
\ No newline at end of file
+
+def contour_session(var,lev=None,filled=True,levels=None,ds_name=''):
+    """
+    Build a reusable MapSession drawing var as contour_var does.
+    Use contour_frame to draw each time step.
+    Levels must be given (or are fixed by the first frame)
+    so that the colorbar is valid for all the time steps.
+    """
+
+    # Extract lat and lon
+    lons = var['longitude'].values[:]
+    lats = var['latitude'].values[:]
+
+    LEV_descr = f'{lev} hPa' if lev not in [None, 'sfc'] else 'sfc'
+
+    # Name and units only, from a single time step
+    _, var_name, var_units = convert_get_attr(var.isel(time=0))
+    cfill, cline = get_colors(var)
+
+    session = MapSession(lons,lats,levels=levels,cmap=cfill,
+                         filled=filled,color=cline,
+                         alpha=0.7 if filled else 0.75,
+                         label=f'{var_name} ({var_units})',
+                         figsize=(8,8))
+
+    session.ax.text(0,1.01,
+                    f'Lev = {LEV_descr}',
+                    fontsize='large',transform=session.ax.transAxes)
+    
+    if not filled:
+        session.ax.text(0,1.04,
+                        f'{var_name} ({var_units})',
+                        fontsize='large',transform=session.ax.transAxes,weight='bold')
+
+    session.ax.set_title(f'{ds_name}',loc='left',fontsize='xx-large',weight='bold',pad=20)
+    session.title.set_fontsize('large')
+
+    return session
+
+
+
+def contour_frame(session,var,T,lev=None):
+    """
+    Draw var at time T (and level lev) on a session built by contour_session
+    """
+
+    VAR, _ = _select_level(var,T,lev)
+    VAR, _, _ = convert_get_attr(VAR)
+
+    TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a %d %h %y  %H UTC')
+
+    return session.update(VAR,title=TIME_STAMP)
+
+
+
+def contour_panel(ds,T,layers,shared=True,ncols=2,ds_name='',bbox=None,center=None,radius=None):
+    """
+    Draw several variables and pressure levels of a Dataset at time T,
+    either overlaid on one map or on a grid of maps, one per layer.
+    All the slices are extracted with a single dask.compute.
+
+            Parameters:
+                    ds (xarray.Dataset): Predictors dataset
+                    T (xarray.DataArray): Time
+                    layers (list): (variable, level, filled) tuples, level in hPa or None/'sfc'
+                    shared (bool): Overlay all the layers on the same axes
+                    ncols (int): Number of columns of the grid, if not shared
+                    ds_name (str): Dataset name
+                    bbox (tuple): Subdomain (lon_min, lon_max, lat_min, lat_max) to read and draw
+                    center, radius: Subdomain as a box around a location, if bbox is None
+
+            Returns:
+                    fig (matplotlib.figure.Figure)
+    """
+    import cartopy.crs as ccrs
+    import dask
+
+    # Read only the subdomain, if requested
+    ds = crop(ds,bbox=bbox,center=center,radius=radius)
+
+    # Get time stamp
+    TIME_STAMP = pd.to_datetime(str(T.values)).strftime('%a %d %h %y  %H UTC')
+
+    # Extract lat and lon
+    lons = ds['longitude'].values[:]
+    lats = ds['latitude'].values[:]
+
+    # Extract and convert all the slices at once
+    slices, descr = [], []
+    for name, lev, filled in layers:
+        VAR, LEV_descr = _select_level(ds[name],T,lev)
+        VAR, var_name, var_units = convert_get_attr(VAR)
+        slices.append(VAR)
+        descr.append(f'{var_name} ({var_units}), {LEV_descr}')
+
+    with phase('extract'):
+        slices = dask.compute(*slices)
+        for s in slices:
+            record_bytes('extract',s)
+
+    # Make plot
+    if shared:
+        fig, ax = plt.subplots(subplot_kw={'projection':ccrs.PlateCarree()},figsize=(8,8))
+        ax = decorate_axes(ax,lons,lats)
+        axes = [ax]*len(layers)
+    else:
+        nrows = -(-len(layers)//ncols)
+        fig, ax = plt.subplots(nrows,ncols,subplot_kw={'projection':ccrs.PlateCarree()},
+                               figsize=(8*ncols,8*nrows),squeeze=False)
+        axes = list(ax.ravel())
+        for extra in axes[len(layers):]:
+            extra.set_visible(False)
+        axes = [decorate_axes(a,lons,lats) for a in axes[:len(layers)]]
+
+    fig.text(0.1, 0.95, f'{ds_name}',
+             transform=fig.transFigure,ha='left',fontsize='xx-large',weight='bold')
+    fig.text(0.9, 0.95, f'{TIME_STAMP}',
+             transform=fig.transFigure,ha='right',fontsize='large',weight='bold')
+
+    # Filled contours first, lines on top
+    order = sorted(range(len(layers)),key=lambda i: not layers[i][2])
+
+    lines_descr = {}
+    for i in order:
+        name, lev, filled = layers[i]
+        CMAP, cline_color = get_colors(ds[name])
+
+        if filled:
+            _draw_filled(fig,axes[i],lons,lats,slices[i],CMAP,label=descr[i])
+        else:
+            _draw_lines(axes[i],lons,lats,slices[i],cline_color)
+            lines_descr.setdefault(id(axes[i]),[]).append((descr[i],cline_color))
+
+    # Description of line layers, above each axes
+    for a in set(axes):
+        for j, (text, color) in enumerate(lines_descr.get(id(a),[])):
+            a.text(0,1.01+0.03*j,text,color=color,
+                   fontsize='large',transform=a.transAxes,weight='bold')
+
+    return fig
@@ -0,0 +1,123 @@
+'''
+Opt-in instrumentation of the plotting functions.
+
+Within a profile() block the plotting functions record the time spent
+in each phase (data extraction, background decoration, contouring,
+image encoding, ...), the bytes extracted, the figures left open and
+the peak memory of the process. Outside of it the hooks do nothing.
+
+    with profile(callback=send_metrics) as prof:
+        fig = maps.plot_prec(prec,T,loc)
+    print(prof.to_json())
+
+Only the current process is instrumented: frames rendered by worker
+processes (maps.render_frames) are not included.
+'''
+import contextlib
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+
+# Profiler collecting the measurements, if any
+_active = None
+
+
+
+class Profiler:
+    '''
+    Timings, bytes read and counters of the instrumented phases.
+
+            Parameters:
+                    callback (function): Called with the report at the end of the profile() block
+    '''
+
+    def __init__(self,callback=None):
+        self.callback = callback
+        self.phases = {}
+        self.start = time.perf_counter()
+        self.elapsed = None
+
+
+    def add(self,name,elapsed=0.,nbytes=0,calls=1):
+
+        p = self.phases.setdefault(name,{'calls' : 0,'time' : 0.,'bytes' : 0})
+        p['calls'] += calls
+        p['time'] += elapsed
+        p['bytes'] += nbytes
+
+
+    def report(self):
+        '''
+        Returns the measurements as a dict.
+        '''
+        report = {'elapsed' : time.perf_counter()-self.start if self.elapsed is None else self.elapsed,
+                  'phases' : self.phases}
+
+        if 'matplotlib.pyplot' in sys.modules:
+            report['open_figures'] = len(sys.modules['matplotlib.pyplot'].get_fignums())
+
+        # Peak resident memory (kB on Linux)
+        if resource is not None:
+            report['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        return report
+
+
+    def to_json(self,**kwargs):
+        return json.dumps(self.report(),**kwargs)
+
+
+
+@contextlib.contextmanager
+def profile(callback=None):
+    '''
+    Instrument the plotting functions called within the block.
+    '''
+    global _active
+
+    previous = _active
+    _active = profiler = Profiler(callback)
+
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        profiler.elapsed = time.perf_counter()-profiler.start
+        if callback is not None:
+            callback(profiler.report())
+
+
+
+@contextlib.contextmanager
+def phase(name):
+    '''
+    Time the enclosed code as the given phase, if profiling is active.
+    '''
+    if _active is None:
+        yield
+        return
+
+    profiler = _active
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profiler.add(name,time.perf_counter()-start)
+
+
+
+def record_bytes(name,array):
+    '''
+    Add the size of an extracted array to the given phase, returning the array.
+    '''
+    if _active is not None:
+        _active.add(name,nbytes=getattr(array,'nbytes',0),calls=0)
+
+    return array
@@ -0,0 +1,296 @@
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+from scipy import sparse
+
+from grids import fix_coordinates, grid_hash, GridIndex, EARTH_RADIUS
+from cache import default_cache_dir
+
+
+
+# Weight matrices already loaded, by key
+_weights_cache = {}
+
+# Part of the cache keys, to be changed when the weights change
+_weights_version = 2
+
+
+
+#############################
+# Weights
+#############################
+
+def cell_edges(c):
+    '''
+    Cell edges of 1-D cell centres.
+    '''
+    c = np.asarray(c,dtype=float)
+    if c.size == 1:
+        return np.array([c[0]-0.5,c[0]+0.5])
+
+    mid = (c[1:]+c[:-1])/2
+
+    return np.concatenate(([2*c[0]-mid[0]],mid,[2*c[-1]-mid[-1]]))
+
+
+
+def _wrap_to(c,origin,period):
+    '''
+    Coordinate wrapped to origin..origin+period (e.g. target longitudes
+    to the convention of the source).
+    '''
+    return origin + (c-origin) % period
+
+
+
+def _overlap_weights(src,dst,transform=None,period=None):
+    '''
+    (dst x src) sparse matrix of the overlap of the cells of two 1-D coordinates.
+    transform maps edges before measuring (e.g. sin of latitude, for areas on the sphere).
+    With a period (e.g. 360 for longitudes) the target cells are wrapped to the
+    convention of the source, and cells overlap across the seam.
+    '''
+    src = np.asarray(src,dtype=float)
+    dst = np.asarray(dst,dtype=float)
+
+    s_order = np.argsort(src)
+    d_order = np.argsort(dst)
+    s, d = src[s_order], dst[d_order]
+
+    se, de = cell_edges(s), cell_edges(d)
+    s_lo, s_hi, d_lo, d_hi = se[:-1], se[1:], de[:-1], de[1:]
+
+    if period is not None:
+        # Target cells shifted by whole periods, copies of the source cells one period away
+        shift = _wrap_to(d,s[0],period) - d
+        d_lo, d_hi = d_lo+shift, d_hi+shift
+        s_lo = np.concatenate((s_lo-period,s_lo,s_lo+period))
+        s_hi = np.concatenate((s_hi-period,s_hi,s_hi+period))
+        s_order = np.tile(s_order,3)
+
+    if transform is not None:
+        s_lo, s_hi, d_lo, d_hi = map(transform,(s_lo,s_hi,d_lo,d_hi))
+
+    rows, cols, vals = [], [], []
+    for i in range(d_lo.size):
+        j0 = np.searchsorted(s_hi,d_lo[i],side='right')
+        j1 = np.searchsorted(s_lo,d_hi[i],side='left')
+        j = np.arange(j0,j1)
+        overlap = np.minimum(s_hi[j],d_hi[i]) - np.maximum(s_lo[j],d_lo[i])
+        keep = overlap > 0
+        rows.append(np.full(keep.sum(),d_order[i]))
+        cols.append(s_order[j[keep]])
+        vals.append(overlap[keep])
+
+    return sparse.csr_matrix((np.concatenate(vals),(np.concatenate(rows),np.concatenate(cols))),
+                             shape=(dst.size,src.size))
+
+
+
+def _linear_weights(src,dst,period=None):
+    '''
+    (dst x src) sparse matrix of the linear interpolation between two 1-D coordinates.
+    Points outside the source coordinate get no weight. With a period (e.g. 360
+    for longitudes) the target is wrapped to the convention of the source,
+    and a global source is interpolated across the seam.
+    '''
+    order = np.argsort(src)
+    s = np.asarray(src,dtype=float)[order]
+    d = np.asarray(dst,dtype=float)
+
+    if period is not None:
+        d = _wrap_to(d,s[0],period)
+        if s.size > 1 and s[-1]-s[0]+np.median(np.diff(s)) >= period*(1-1e-6):
+            s = np.append(s,s[0]+period)
+            order = np.append(order,order[0])
+
+    if s.size == 1:
+        inside = d == s[0]
+        rows = np.flatnonzero(inside)
+        return sparse.csr_matrix((np.ones(rows.size),(rows,np.zeros(rows.size,dtype=int))),
+                                 shape=(d.size,1))
+
+    j = np.clip(np.searchsorted(s,d)-1,0,s.size-2)
+    w = (d-s[j])/(s[j+1]-s[j])
+    inside = (d >= s[0]) & (d <= s[-1])
+
+    rows = np.flatnonzero(inside)
+    rows2 = np.concatenate((rows,rows))
+    cols = np.concatenate((order[j[inside]],order[j[inside]+1]))
+    vals = np.concatenate((1-w[inside],w[inside]))
+
+    return sparse.csr_matrix((vals,(rows2,cols)),shape=(d.size,np.size(src)))
+
+
+
+def _spatial(ds):
+    '''
+    Latitude, longitude, spatial dims and shape of a dataset grid.
+    '''
+    lat = ds['latitude']
+    lon = ds['longitude']
+
+    if lat.ndim == 1 and lon.ndim == 1:
+        return lat, lon, (lat.dims[0],lon.dims[0]), (lat.size,lon.size)
+
+    return lat, lon, lat.dims, lat.shape
+
+
+
+def _nearest_weights(src,dst):
+
+    s_lat, s_lon, s_dims, s_shape = _spatial(src)
+    d_lat, d_lon, _, d_shape = _spatial(dst)
+
+    if d_lat.ndim == 1:
+        LAT, LON = np.meshgrid(d_lat.values,d_lon.values,indexing='ij')
+    else:
+        LAT, LON = d_lat.values, d_lon.values
+
+    index = GridIndex.from_dataset(src)
+    indexes, distance = index.query(LAT.ravel(),LON.ravel())
+    by_dim = dict(zip(index.dims,indexes))
+    cols = np.ravel_multi_index(tuple(by_dim[d] for d in s_dims),s_shape)
+
+    # Target points farther than half the diagonal of the closest source cell
+    # are outside the source grid (whatever the longitude conventions) and get no weight
+    if index.regular:
+        ilon, ilat = indexes
+        dlat = np.abs(np.gradient(index.lat))[ilat] if index.lat.size > 1 else np.zeros(ilat.size)
+        dlon = np.abs(np.gradient(np.unwrap(index.lon,period=360)))[ilon] if index.lon.size > 1 else np.zeros(ilon.size)
+        dlon = dlon*np.cos(np.deg2rad(index.lat[ilat]))
+        limit = EARTH_RADIUS*np.deg2rad(np.hypot(dlat,dlon))/2
+    else:
+        # The 4th neighbour of a grid point is about one cell away along the longer side
+        flat = np.ravel_multi_index(indexes,index.shape)
+        chord, _ = index.tree.query(index.tree.data[flat],k=min(5,index.tree.n))
+        limit = 0.75*2*EARTH_RADIUS*np.arcsin(np.clip(chord[:,-1]/2,0,1))
+
+    inside = distance <= limit*(1+1e-6)
+    rows = np.flatnonzero(inside)
+
+    return sparse.csr_matrix((np.ones(rows.size),(rows,cols[inside])),
+                             shape=(int(np.prod(d_shape)),int(np.prod(s_shape))))
+
+
+
+def regrid_weights(source,target,method='bilinear',cache_dir=None):
+    '''
+    Returns the sparse (target points x source points) regridding weights
+    between two grids, computed once per pair of grids and cached on disk.
+
+            Parameters:
+                    source, target (xarray.Dataset or xarray.DataArray): Source and target grids
+                    method (str): 'nearest', 'bilinear' or 'conservative'
+                                  (bilinear and conservative need 1-D coordinates)
+                    cache_dir (str): Cache directory (cache.default_cache_dir if None)
+
+            Returns:
+                    weights (scipy.sparse.csr_matrix): Points in C order of the (latitude, longitude) dims
+    '''
+    src = fix_coordinates(source)
+    dst = fix_coordinates(target)
+
+    key = hashlib.sha1(f'{grid_hash(src)}|{grid_hash(dst)}|{method}|{_weights_version}'.encode()).hexdigest()
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    cache_dir = os.path.join(default_cache_dir if cache_dir is None else cache_dir,'regrid')
+    path = os.path.join(cache_dir,f'{key}.npz')
+
+    if os.path.exists(path):
+        weights = sparse.load_npz(path).tocsr()
+
+    else:
+        if method == 'nearest':
+            weights = _nearest_weights(src,dst)
+
+        elif method in ('bilinear','conservative'):
+            if src['latitude'].ndim != 1 or dst['latitude'].ndim != 1:
+                raise ValueError(f'{method} regridding needs 1-D coordinates')
+
+            s_lat, s_lon = src['latitude'].values, src['longitude'].values
+            d_lat, d_lon = dst['latitude'].values, dst['longitude'].values
+
+            # Weights are separable on rectilinear grids,
+            # longitudes are compared whatever their convention (0..360 or -180..180)
+            if method == 'bilinear':
+                w_lat = _linear_weights(s_lat,d_lat)
+                w_lon = _linear_weights(s_lon,d_lon,period=360)
+            else:
+                sin = lambda x: np.sin(np.deg2rad(np.clip(x,-90,90)))
+                w_lat = _overlap_weights(s_lat,d_lat,transform=sin)
+                w_lon = _overlap_weights(s_lon,d_lon,period=360)
+
+            weights = sparse.kron(w_lat,w_lon,format='csr')
+
+        else:
+            raise ValueError(f'Unknown method: {method}')
+
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        sparse.save_npz(tmp,weights)
+        os.replace(tmp,path)
+
+    _weights_cache[key] = weights
+
+    return weights
+
+
+
+#############################
+# Regridding
+#############################
+
+def regrid(dataarray,target,method='bilinear',cache_dir=None):
+    '''
+    Regrid a data array to the grid of another dataset.
+
+    All the time steps of each chunk are regridded with one sparse matrix
+    product; NaN are ignored, renormalizing the weights of the valid points.
+
+            Parameters:
+                    dataarray (xarray.DataArray): Data to regrid
+                    target (xarray.Dataset or xarray.DataArray): Dataset on the target grid
+                    method (str): 'nearest', 'bilinear' or 'conservative'
+                    cache_dir (str): Cache directory of the weights
+
+            Returns:
+                    regridded (xarray.DataArray): Lazy if dataarray is dask-backed
+    '''
+    src = fix_coordinates(dataarray)
+    dst = fix_coordinates(target)
+
+    weights = regrid_weights(src,dst,method=method,cache_dir=cache_dir)
+
+    _, _, s_dims, s_shape = _spatial(src)
+    d_lat, d_lon, d_dims, d_shape = _spatial(dst)
+
+    def _apply(x):
+        lead = x.shape[:-2]
+        flat = x.reshape(-1,x.shape[-2]*x.shape[-1])
+
+        valid = ~np.isnan(flat)
+        num = weights.dot(np.where(valid,flat,0).T).T
+        den = weights.dot(valid.T.astype(float)).T
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            out = np.where(den > 0,num/den,np.nan)
+
+        return out.reshape(lead+tuple(d_shape))
+
+    if src.chunks is not None:
+        src = src.chunk({d : -1 for d in s_dims})
+
+    out = xr.apply_ufunc(_apply,src,
+                         input_core_dims=[list(s_dims)],
+                         output_core_dims=[list(d_dims)],
+                         exclude_dims=set(s_dims),
+                         dask='parallelized',
+                         output_dtypes=[float],
+                         dask_gufunc_kwargs={'output_sizes' : dict(zip(d_dims,d_shape))},
+                         keep_attrs=True)
+
+    return out.assign_coords({'latitude' : d_lat,'longitude' : d_lon})
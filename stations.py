@@ -0,0 +1,178 @@
+import os
+
+import numpy as np
+import xarray as xr
+
+from grids import fix_coordinates, get_grid_index
+
+
+
+def storage_chunks(dataarray):
+    '''
+    Returns the chunk size of each dimension of a data array, as stored
+    on disk (netCDF/HDF5 or Zarr encoding), else its dask chunks.
+    Dimensions that are not chunked get their full size.
+    '''
+    da = dataarray
+    sizes = dict(da.sizes)
+
+    chunks = da.encoding.get('preferred_chunks')
+    if chunks:
+        return {d : int(chunks.get(d,n)) for d, n in sizes.items()}
+
+    chunks = da.encoding.get('chunksizes') or da.encoding.get('chunks')
+    if chunks and len(chunks) == da.ndim:
+        return {d : int(c) for d, c in zip(da.dims,chunks)}
+
+    if da.chunks is not None:
+        return {d : int(max(c)) for d, c in zip(da.dims,da.chunks)}
+
+    return sizes
+
+
+
+def _cap_chunks(chunks,dims,itemsize,max_bytes):
+    '''
+    Halve a block along each of dims in turn (e.g. time first)
+    until it holds at most max_bytes.
+    '''
+    chunks = dict(chunks)
+    nbytes = lambda: itemsize*int(np.prod([chunks[d] for d in chunks]))
+
+    for d in dims:
+        while nbytes() > max_bytes and chunks[d] > 1:
+            chunks[d] = -(-chunks[d]//2)
+
+    return chunks
+
+
+
+def station_indexes(stations,dataset,max_distance=None):
+    '''
+    Map stations to their closest grid points, all at once.
+
+            Parameters:
+                    stations (pandas.DataFrame): Stations, with 'latitude' and 'longitude' columns
+                    dataset (xarray.Dataset or xarray.DataArray): Target dataset
+                    max_distance (float): Drop stations farther than this (km) from the grid
+
+            Returns:
+                    indexes (pandas.DataFrame): stations with the index along each grid
+                                                dimension and the distance (km) to the grid point
+    '''
+    index = get_grid_index(dataset)
+
+    indexes, distance = index.query(stations['latitude'].to_numpy(),stations['longitude'].to_numpy())
+
+    out = stations.copy()
+    for d, i in zip(index.dims,indexes):
+        out[f'{d}_index'] = i
+    out['distance_km'] = distance
+
+    if max_distance is not None:
+        out = out[out['distance_km'] <= max_distance]
+
+    return out
+
+
+
+def extract_stations(dataset,stations,path,variables=None,station_id=None,max_distance=None,
+                     max_block_bytes=2**28):
+    '''
+    Extract the time series of many stations to a Parquet dataset.
+
+    Stations are grouped by the on-disk chunk of the grid containing their
+    closest grid point, and each (spatial chunk, time chunk) block is read
+    once for all its stations, so the I/O is proportional to the chunks
+    touched rather than to the number of stations. Contiguous (unchunked)
+    data is read in blocks of at most max_block_bytes. Results are written
+    as they are read, partitioned by spatial chunk:
+
+        path/chunk=<i>_<j>/part-<k>.parquet    (station, time, variables)
+        path/_stations.parquet                 (stations and grid points)
+
+            Parameters:
+                    dataset (xarray.Dataset): Dataset, e.g. with precipitation and return period
+                    stations (pandas.DataFrame): Stations, with 'latitude' and 'longitude' columns
+                    path (str): Output directory
+                    variables (list): Variables to extract, all those on the grid if None
+                    station_id (str): Column of stations identifying them, the index if None
+                    max_distance (float): Skip stations farther than this (km) from the grid
+                    max_block_bytes (int): Size of the blocks read from unchunked data
+
+            Returns:
+                    indexes (pandas.DataFrame): Extracted stations and their grid points
+    '''
+    ds = fix_coordinates(dataset)
+
+    index = get_grid_index(ds)
+    spatial_dims = list(index.dims)
+
+    if variables is None:
+        variables = [v for v in ds.data_vars if set(spatial_dims) <= set(ds[v].dims)]
+    ds = ds[variables]
+
+    stations = stations.copy()
+    stations['station'] = stations.index.to_numpy() if station_id is None else stations[station_id].to_numpy()
+
+    indexes = station_indexes(stations,ds,max_distance=max_distance)
+
+    chunks = storage_chunks(ds[variables[0]])
+    has_time = 'time' in ds.dims
+
+    # Unchunked storage: read it in blocks, smaller along time first
+    if chunks == dict(ds[variables[0]].sizes):
+        itemsize = sum(ds[v].dtype.itemsize for v in variables)
+        chunks = _cap_chunks(chunks,(['time'] if has_time else [])+spatial_dims,
+                             itemsize,max_block_bytes)
+
+    # Spatial chunk of each station
+    columns = [f'{d}_index' for d in spatial_dims]
+    for d, c in zip(spatial_dims,columns):
+        indexes[f'{d}_chunk'] = indexes[c]//chunks[d]
+    chunk_columns = [f'{d}_chunk' for d in spatial_dims]
+
+    # Time blocks, aligned to the on-disk chunks
+    if has_time:
+        ntime, tchunk = ds.sizes['time'], chunks.get('time',ds.sizes['time'])
+        time_blocks = [slice(t,min(t+tchunk,ntime)) for t in range(0,ntime,tchunk)]
+    else:
+        time_blocks = [None]
+
+    os.makedirs(path,exist_ok=True)
+
+    # Location of the grid points
+    lats = ds['latitude'].values
+    lons = ds['longitude'].values
+    point = tuple(indexes[c].to_numpy() for c in columns)
+    if lats.ndim == 1:
+        by_dim = dict(zip(spatial_dims,point))
+        indexes['grid_latitude'] = lats[by_dim[ds['latitude'].dims[0]]]
+        indexes['grid_longitude'] = lons[by_dim[ds['longitude'].dims[0]]]
+    else:
+        indexes['grid_latitude'] = lats[point]
+        indexes['grid_longitude'] = lons[point]
+
+    indexes.to_parquet(os.path.join(path,'_stations.parquet'),index=False)
+
+    for key, group in indexes.sort_values(chunk_columns).groupby(chunk_columns,sort=False):
+        key = np.atleast_1d(key)
+
+        # Bounds of the spatial chunk and station indexes within it
+        block = {d : slice(int(k)*chunks[d],(int(k)+1)*chunks[d]) for d, k in zip(spatial_dims,key)}
+        local = {d : xr.DataArray(group[c].to_numpy()-block[d].start,dims='station')
+                 for d, c in zip(spatial_dims,columns)}
+
+        chunk_dir = os.path.join(path,'chunk='+'_'.join(str(int(k)) for k in key))
+        os.makedirs(chunk_dir,exist_ok=True)
+
+        spatial_block = ds.isel(block)
+
+        for k, tb in enumerate(time_blocks):
+            values = (spatial_block if tb is None else spatial_block.isel(time=tb)).load()
+            points = values.isel(local).assign_coords(station=group['station'].to_numpy())
+
+            df = points.drop_vars([c for c in points.coords if c not in ('station','time')]).to_dataframe()
+            df.reset_index().to_parquet(os.path.join(chunk_dir,f'part-{k:05d}.parquet'),index=False)
+
+    return indexes
@@ -1,17 +1,272 @@
-def min_max_xarray(da):
-    if da.long_name:
-        lname = da.long_name
+import os
+
+import numpy as np
+import xarray as xr
+
+
+
+def summary_stats(da,dim=None):
+    '''
+    Compute summary statistics of a data array in a single pass.
+
+    All the reductions are built lazily and evaluated together
+    with one dask.compute, so a dask-backed array is read only once
+    (in-memory arrays are reduced directly, without needing dask).
+
+            Parameters:
+                    da (xarray.DataArray): Input data
+                    dim (str or list): Dimension(s) to reduce over, all if None
+                                       (e.g. ['latitude','longitude'] for statistics per time step,
+                                       'time' for statistics per grid point)
+
+            Returns:
+                    stats (xarray.Dataset): min, max, mean, std, nan_count and count,
+                                            plus argmin_<dim> and argmax_<dim> indexes
+                                            (-1 where all values are NaN)
+    '''
+    if dim is None:
+        dims = list(da.dims)
+    elif isinstance(dim,str):
+        dims = [dim]
     else:
-        lname = 'Data array'
-    if da.units:
-        units = da.units
+        dims = list(dim)
+
+    isnull = da.isnull()
+
+    lazy = {'min' : da.min(dim=dims),
+            'max' : da.max(dim=dims),
+            'mean' : da.mean(dim=dims),
+            'std' : da.std(dim=dims),
+            'nan_count' : isnull.sum(dim=dims),
+            'count' : da.notnull().sum(dim=dims)}
+
+    # NaN are replaced so that all-NaN slices do not raise
+    argmin = da.fillna(np.inf).argmin(dim=dims)
+    argmax = da.fillna(-np.inf).argmax(dim=dims)
+
+    for d in dims:
+        lazy[f'argmin_{d}'] = argmin[d]
+        lazy[f'argmax_{d}'] = argmax[d]
+
+    names = list(lazy)
+    if da.chunks is not None:
+        import dask
+        values = dask.compute(*[lazy[n] for n in names])
     else:
-        units = ''
+        values = [lazy[n] for n in names]
+
+    stats = xr.Dataset(dict(zip(names,values)))
+
+    all_nan = stats['count'] == 0
+    for d in dims:
+        stats[f'argmin_{d}'] = stats[f'argmin_{d}'].where(~all_nan,-1)
+        stats[f'argmax_{d}'] = stats[f'argmax_{d}'].where(~all_nan,-1)
+
+    stats.attrs['long_name'] = da.attrs.get('long_name','')
+    stats.attrs['units'] = da.attrs.get('units','')
 
-    min = da.min().compute()
-    max = da.max().compute()
+    return stats
+
+
+
+def min_max_xarray(da):
+    lname = da.attrs.get('long_name') or 'Data array'
+    units = da.attrs.get('units') or ''
+
+    stats = summary_stats(da)
+
+    min = stats['min']
+    max = stats['max']
 
     print(f'{lname} global minimum: {min.values} {units}')
     print(f'{lname} global maximum: {max.values} {units}')
 
-    return
\ No newline at end of file
+    return min, max
+
+
+
+class StreamingStats:
+    '''
+    Online statistics of a field arriving one time step (or a few) at a time.
+
+    Keeps per grid point count, mean and variance (Welford/Chan updates),
+    minimum, maximum and the number of values exceeding each threshold,
+    so memory does not depend on the length of the record.
+    Accumulators of separate workers can be merged, and saved to
+    or loaded from disk as checkpoints.
+
+            Parameters:
+                    thresholds (iterable): Exceedance thresholds,
+                                           e.g. list(maps.clevs_thresh) or list(maps.clevs_rp)
+                    dim (str): Name of the time dimension
+    '''
+
+    def __init__(self,thresholds=(),dim='time'):
+
+        self.thresholds = np.sort(np.asarray(list(thresholds),dtype=float))
+        self.dim = dim
+
+        # Set by the first update
+        self.dims = None
+        self.coords = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+        self.min = None
+        self.max = None
+        self.exceed = None
+        self.last_time = None
+
+
+    def update(self,da):
+        '''
+        Add a new time slice (or a block of time steps) of the field.
+        '''
+
+        if self.dim in da.dims:
+            da = da.transpose(self.dim,...)
+            values = np.asarray(da.values,dtype=float)
+            self.last_time = da[self.dim].values[-1]
+        else:
+            values = np.asarray(da.values,dtype=float)[np.newaxis]
+            if self.dim in da.coords:
+                self.last_time = da[self.dim].values
+
+        if self.dims is None:
+            self.dims = tuple(d for d in da.dims if d != self.dim)
+            self.coords = {d : da[d].values for d in self.dims if d in da.coords}
+        
+        valid = ~np.isnan(values)
+        count = valid.sum(axis=0)
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            mean = np.where(count > 0,np.nansum(values,axis=0)/count,0.)
+            m2 = np.nansum((values-mean)**2,axis=0)
+
+        vmin = np.fmin.reduce(values,axis=0)
+        vmax = np.fmax.reduce(values,axis=0)
+        exceed = np.stack([(values >= t).sum(axis=0) for t in self.thresholds]) \
+                 if self.thresholds.size else np.zeros((0,)+count.shape,dtype=int)
+        
+        self._combine(count,mean,m2,vmin,vmax,exceed)
+
+        return self
+
+
+    def merge(self,other):
+        '''
+        Merge the statistics accumulated by another StreamingStats.
+        '''
+        if not np.array_equal(self.thresholds,other.thresholds):
+            raise ValueError('Cannot merge statistics with different thresholds')
+
+        if other.count is None:
+            return self
+        
+        if self.dims is None:
+            self.dims = other.dims
+            self.coords = other.coords
+
+        self._combine(other.count,other.mean,other.m2,other.min,other.max,other.exceed)
+
+        if other.last_time is not None:
+            if self.last_time is None or other.last_time > self.last_time:
+                self.last_time = other.last_time
+
+        return self
+
+
+    def _combine(self,count,mean,m2,vmin,vmax,exceed):
+
+        if self.count is None:
+            self.count, self.mean, self.m2 = count, mean, m2
+            self.min, self.max, self.exceed = vmin, vmax, exceed
+            return
+
+        n = self.count + count
+        delta = mean - self.mean
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            self.mean = np.where(n > 0,self.mean + delta*count/n,0.)
+            self.m2 = np.where(n > 0,self.m2 + m2 + delta**2*self.count*count/n,0.)
+
+        self.count = n
+        self.min = np.fmin(self.min,vmin)
+        self.max = np.fmax(self.max,vmax)
+        self.exceed = self.exceed + exceed
+
+
+    def result(self,ddof=0):
+        '''
+        Returns the accumulated statistics as an xarray.Dataset.
+        '''
+        if self.count is None:
+            raise ValueError('No data accumulated yet')
+
+        empty = self.count == 0
+
+        with np.errstate(invalid='ignore',divide='ignore'):
+            var = np.where(self.count > ddof,self.m2/(self.count-ddof),np.nan)
+
+        dims = self.dims
+        stats = xr.Dataset({'count' : (dims,self.count),
+                            'mean' : (dims,np.where(empty,np.nan,self.mean)),
+                            'var' : (dims,var),
+                            'std' : (dims,np.sqrt(var)),
+                            'min' : (dims,self.min),
+                            'max' : (dims,self.max),
+                            'exceedance_count' : (('threshold',)+dims,self.exceed)},
+                           coords=dict(self.coords,threshold=self.thresholds))
+
+        if self.last_time is not None:
+            stats.attrs['last_time'] = str(self.last_time)
+
+        return stats
+
+
+    def save(self,path):
+        '''
+        Write a checkpoint of the accumulator to disk (numpy .npz).
+        '''
+        if self.count is None:
+            raise ValueError('No data accumulated yet')
+        
+        arrays = {'thresholds' : self.thresholds,
+                  'dim' : np.array(self.dim),
+                  'dims' : np.array(self.dims),
+                  'count' : self.count,
+                  'mean' : self.mean,
+                  'm2' : self.m2,
+                  'min' : self.min,
+                  'max' : self.max,
+                  'exceed' : self.exceed}
+        arrays.update({f'coord_{d}' : c for d, c in self.coords.items()})
+        if self.last_time is not None:
+            arrays['last_time'] = np.asarray(self.last_time)
+
+        # Replace the previous checkpoint only once the new one is complete
+        tmp = f'{path}.tmp'
+        with open(tmp,'wb') as f:
+            np.savez(f,**arrays)
+        os.replace(tmp,path)
+
+
+    @classmethod
+    def load(cls,path):
+        '''
+        Read an accumulator checkpoint written by save().
+        '''
+        with np.load(path) as f:
+            acc = cls(thresholds=f['thresholds'],dim=str(f['dim']))
+            acc.dims = tuple(str(d) for d in f['dims'])
+            acc.coords = {k[len('coord_'):] : f[k] for k in f.files if k.startswith('coord_')}
+            acc.count = f['count']
+            acc.mean = f['mean']
+            acc.m2 = f['m2']
+            acc.min = f['min']
+            acc.max = f['max']
+            acc.exceed = f['exceed']
+            if 'last_time' in f.files:
+                acc.last_time = f['last_time'][()]
+
+        return acc
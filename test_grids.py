@@ -0,0 +1,73 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+
+import grids
+
+
+
+def synthetic_prec(step=0.05,ntime=2):
+
+    lat = np.arange(36.,44.,step)
+    lon = np.arange(-9.,3.,step)
+    time = pd.date_range('2000-01-01',periods=ntime,freq='6h')
+
+    rng = np.random.default_rng(0)
+    data = rng.gamma(0.3,4.,size=(ntime,lat.size,lon.size))
+
+    return xr.DataArray(data,coords={'time' : time,'latitude' : lat,'longitude' : lon},
+                        dims=('time','latitude','longitude'),name='prec')
+
+
+
+def random_centers(n=40,seed=1):
+
+    rng = np.random.default_rng(seed)
+
+    return [{'lat' : float(lat),'lon' : float(lon)}
+            for lat, lon in zip(rng.uniform(37.,43.,n),rng.uniform(-8.,2.,n))]
+
+
+
+def test_in_circle_points_match_geopandas():
+    pytest.importorskip('geopandas')
+
+    prec = synthetic_prec()
+
+    for center in random_centers():
+        gdf = grids.in_circle(prec,center,radius=0.2)
+        expected = set(zip(gdf['latitude'],gdf['longitude']))
+
+        points = grids.in_circle(prec.isel(time=0),center,radius=0.2,mode='points')
+        found = set(zip(points['latitude'].values,points['longitude'].values))
+
+        assert found == expected
+
+
+
+def test_in_circle_mask_matches_points():
+
+    prec = synthetic_prec()
+
+    for center in random_centers(10):
+        masked = grids.in_circle(prec,center,radius=0.2,mode='mask')
+        points = grids.in_circle(prec,center,radius=0.2,mode='points')
+
+        assert int(masked.isel(time=0).notnull().sum()) == points.sizes['point']
+
+
+
+def test_in_circles_matches_in_circle_mask():
+
+    prec = synthetic_prec().isel(time=0)
+    centers = pd.DataFrame(random_centers())
+
+    offsets, indexes = grids.in_circles(prec,centers,radius=0.2)
+
+    for i, center in enumerate(random_centers()):
+        mask = grids.in_circle_mask(prec,center,radius=0.2).values
+        found = set(zip(indexes['latitude'][offsets[i]:offsets[i+1]],
+                        indexes['longitude'][offsets[i]:offsets[i+1]]))
+
+        assert found == set(zip(*np.nonzero(mask)))
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import xarray as xr
+
+import regrid
+
+
+
+def smooth_field(lat,lon):
+
+    LAT, LON = np.meshgrid(lat,lon,indexing='ij')
+    data = np.cos(np.deg2rad(LAT))*(2+np.sin(np.deg2rad(LON)))
+
+    return xr.DataArray(data,coords={'latitude' : lat,'longitude' : lon},
+                        dims=('latitude','longitude'),name='prec')
+
+
+
+@pytest.mark.parametrize('method',['nearest','bilinear','conservative'])
+def test_regrid_0_360_to_180(method,tmp_path):
+
+    source = smooth_field(np.arange(-60.,60.5,1.),np.arange(0.,360.,1.))
+    target = smooth_field(np.arange(-50.25,50.,2.5),np.arange(-179.75,180.,2.5))
+
+    out = regrid.regrid(source,target,method=method,cache_dir=str(tmp_path))
+
+    assert not out.isnull().any()
+    np.testing.assert_allclose(out.values,target.values,atol=0.05)
+
+
+
+def test_regrid_outside_source_is_nan(tmp_path):
+
+    source = smooth_field(np.arange(30.,50.5,0.5),np.arange(350.,370.,0.5))
+    target = smooth_field(np.arange(20.,60.,1.),np.arange(-30.,30.,1.))
+
+    for method in ('nearest','bilinear'):
+        out = regrid.regrid(source,target,method=method,cache_dir=str(tmp_path))
+
+        inside = (target['latitude'] >= 30) & (target['latitude'] <= 50) & \
+                 (target['longitude'] >= -10) & (target['longitude'] <= 9.5)
+
+        assert not out.where(inside).isnull().where(inside,False).any()
+        assert out.where(~inside).isnull().where(~inside,True).all()
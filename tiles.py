@@ -0,0 +1,277 @@
+import hashlib
+import json
+import math
+import os
+import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+from matplotlib.colors import to_rgba
+from matplotlib.image import imsave
+
+from grids import fix_coordinates, split_extent, GridIndex, EARTH_RADIUS
+
+
+
+# Size (pixels) of the tiles
+TILE_SIZE = 256
+
+# Grid and colour classes of the tiles rendered in a worker process
+_tile_grid = None
+
+
+
+#############################
+# Tile geometry
+#############################
+
+def lonlat_to_tile(lon,lat,z):
+    '''
+    Returns the x, y indexes of the XYZ (slippy map) tile containing a location.
+    '''
+    n = 2**z
+    lat = max(min(lat,85.0511),-85.0511)
+
+    x = int((lon+180)/360*n)
+    y = int((1-math.asinh(math.tan(math.radians(lat)))/math.pi)/2*n)
+
+    return min(max(x,0),n-1), min(max(y,0),n-1)
+
+
+
+def tiles_in_extent(extent,z):
+    '''
+    Returns the (z, x, y) tiles covering an extent (lon_min, lon_max, lat_min, lat_max).
+    '''
+    lon_min, lon_max, lat_min, lat_max = extent
+
+    x0, y0 = lonlat_to_tile(lon_min,lat_max,z)
+    x1, y1 = lonlat_to_tile(lon_max,lat_min,z)
+
+    return [(z,x,y) for x in range(x0,x1+1) for y in range(y0,y1+1)]
+
+
+
+def tile_pixels(z,x,y):
+    '''
+    Returns the longitude and latitude of the centres of the pixels of a tile.
+    '''
+    n = 2**z
+    p = (np.arange(TILE_SIZE)+0.5)/TILE_SIZE
+
+    lon = (x+p)/n*360 - 180
+    lat = np.degrees(np.arctan(np.sinh(np.pi*(1-2*(y+p)/n))))
+
+    LON, LAT = np.meshgrid(lon,lat)
+
+    return LON, LAT
+
+
+
+def _nearest_1d(coord,values,period=None):
+    '''
+    Index of the nearest coordinate to each value, -1 farther than
+    about half the grid spacing (outside the grid or in a gap of it).
+    With a period, the coordinate wraps around (e.g. global longitudes).
+    '''
+    order = np.argsort(coord)
+    c = coord[order]
+    spacing = np.median(np.diff(c)) if c.size > 1 else 0
+
+    if period is not None and c.size > 1 and c[-1]-c[0]+spacing >= period*(1-1e-6):
+        c = np.concatenate((c[-1:]-period,c,c[:1]+period))
+        order = np.concatenate((order[-1:],order,order[:1]))
+
+    i = np.clip(np.searchsorted(c,values),1,max(c.size-1,1))
+    i = i - ((values-c[i-1]) < (c[i]-values))
+    i = np.clip(i,0,c.size-1)
+
+    # Tolerance for slightly irregular grids
+    return np.where(np.abs(values-c[i]) <= 0.75*spacing,order[i],-1)
+
+
+
+#############################
+# Tile rendering
+#############################
+
+def _init_tile_worker(grid):
+    global _tile_grid
+
+    _tile_grid = grid
+    _pixel_index.cache_clear()
+
+
+
+@lru_cache(maxsize=256)
+def _pixel_index(z,x,y):
+    '''
+    Flat index of the grid point of each pixel of a tile (-1 outside the grid).
+    The mapping does not depend on time, so it is computed once per tile.
+    '''
+    LON, LAT = tile_pixels(z,x,y)
+    lats, lons = _tile_grid['lats'], _tile_grid['lons']
+
+    if lats.ndim == 1:
+        ilat = _nearest_1d(lats,LAT.ravel())
+        ilon = _nearest_1d(lons,LON.ravel(),period=360)
+        return np.where((ilat >= 0) & (ilon >= 0),ilat*lons.size+ilon,-1)
+
+    index = _tile_grid['index']
+    (i, j), distance = index.query(LAT.ravel(),LON.ravel())
+
+    return np.where(distance <= _tile_grid['max_distance'],
+                    np.ravel_multi_index((i,j),index.shape),-1)
+
+
+
+def _render_tiles(field,tiles,outdir,prev_dir=None,prev_hashes=None):
+    '''
+    Render a group of tiles of a field, writing only the tiles
+    whose colour classes changed since the previous time step.
+    '''
+    levels = _tile_grid['levels']
+    colors = _tile_grid['colors']
+    prev_hashes = prev_hashes or {}
+
+    flat = field.ravel()
+    hashes = {}
+
+    for z, x, y in tiles:
+
+        idx = _pixel_index(z,x,y)
+        values = np.where(idx >= 0,flat[idx],np.nan)
+
+        # Colour classes as in contourf: levels[i] < v <= levels[i+1],
+        # the lowest one including levels[0]
+        classes = np.maximum(np.digitize(values,levels,right=True) - 1,0)
+        valid = (values >= levels[0]) & (values <= levels[-1]) & ~np.isnan(values)
+        if not valid.any():
+            continue
+
+        classes = np.where(valid,classes,255).astype(np.uint8)
+
+        key = f'{z}/{x}/{y}'
+        hashes[key] = hashlib.sha1(classes.tobytes()).hexdigest()
+
+        path = os.path.join(outdir,f'{key}.png')
+        os.makedirs(os.path.dirname(path),exist_ok=True)
+
+        # Unchanged tile: reuse the previous file
+        if prev_dir is not None and prev_hashes.get(key) == hashes[key]:
+            prev = os.path.join(prev_dir,f'{key}.png')
+            try:
+                os.link(prev,path)
+            except OSError:
+                shutil.copyfile(prev,path)
+            continue
+
+        imsave(path,colors[classes].reshape(TILE_SIZE,TILE_SIZE,4))
+
+    return hashes
+
+
+
+def export_tiles(dataarray,clevs,outdir,zooms=range(4,9),times=None,
+                 processes=None,tiles_per_task=64):
+    '''
+    Export a field as a pyramid of XYZ (slippy map) PNG tiles for each time step,
+    coloured with the contour classes of the maps (clevs_prec, clevs_rp, ...).
+
+    Tiles are written to outdir/<YYYYmmddHHMM>/<z>/<x>/<y>.png, with a tiles.json
+    manifest of the tile hashes. Tiles whose colours did not change since the
+    previous time step are linked instead of rendered again.
+
+            Parameters:
+                    dataarray (xarray.DataArray): Field, e.g. precipitation or return period
+                    clevs (dict): Contour levels and colors
+                    outdir (str): Output directory
+                    zooms (iterable): Zoom levels
+                    times (list or slice): Times to export, all the time steps if None
+                    processes (int): Number of worker processes (all the CPUs if None,
+                                     rendering in the current process if 1)
+                    tiles_per_task (int): Number of tiles rendered by each task
+
+            Returns:
+                    dirs (list): Tile directories, one per time step
+    '''
+
+    da = fix_coordinates(dataarray)
+
+    lats = da['latitude']
+    lons = da['longitude']
+
+    # Tiles are in -180..180, whatever the longitudes of the grid
+    grid = {'lats' : lats.values,
+            'lons' : (lons.values+180) % 360 - 180,
+            'levels' : np.array([float(c) for c in clevs]),
+            'colors' : np.zeros((256,4),dtype=np.uint8)}
+
+    # Class 255 is transparent
+    grid['colors'][:len(clevs)] = [np.round(np.array(to_rgba(clevs[c]))*255) for c in clevs]
+
+    if lats.ndim == 1 and lons.ndim == 1:
+        spatial_dims = (lats.dims[0],lons.dims[0])
+    else:
+        spatial_dims = lats.dims
+        grid['index'] = GridIndex(lats.values,lons.values,dims=spatial_dims)
+        # Pixels farther than the grid spacing are outside the grid
+        spacing, _ = grid['index'].tree.query(grid['index'].tree.data[::97],k=2)
+        grid['max_distance'] = 2*EARTH_RADIUS*np.arcsin(np.median(spacing[:,1])/2)
+
+    extent = (float(lons.min()),float(lons.max()),float(lats.min()),float(lats.max()))
+    tiles = sorted({t for z in zooms for e in split_extent(extent) for t in tiles_in_extent(e,z)})
+    groups = [tiles[i:i+tiles_per_task] for i in range(0,len(tiles),tiles_per_task)]
+
+    time = da['time'] if times is None else da['time'].sel(time=times)
+
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1,min(processes,len(groups)))
+
+    pool = None
+    if processes == 1:
+        _init_tile_worker(grid)
+    else:
+        pool = ProcessPoolExecutor(max_workers=processes,
+                                   mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=_init_tile_worker,
+                                   initargs=(grid,))
+
+    dirs = []
+    prev_dir, prev_hashes = None, {}
+
+    try:
+        for T in time:
+            field = np.asarray(da.sel(time=T).transpose(*spatial_dims).values,dtype=float)
+
+            stamp = pd.to_datetime(str(T.values)).strftime('%Y%m%d%H%M')
+            tdir = os.path.join(outdir,stamp)
+            os.makedirs(tdir,exist_ok=True)
+
+            args = [(field,g,tdir,prev_dir,
+                     {f'{z}/{x}/{y}' : prev_hashes.get(f'{z}/{x}/{y}') for z, x, y in g})
+                    for g in groups]
+
+            if pool is None:
+                results = [_render_tiles(*a) for a in args]
+            else:
+                results = [f.result() for f in [pool.submit(_render_tiles,*a) for a in args]]
+
+            hashes = {}
+            for r in results:
+                hashes.update(r)
+
+            with open(os.path.join(tdir,'tiles.json'),'w') as f:
+                json.dump(hashes,f)
+
+            dirs.append(tdir)
+            prev_dir, prev_hashes = tdir, hashes
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    return dirs
@@ -0,0 +1,192 @@
+import hashlib
+import os
+
+import numpy as np
+import xarray as xr
+import shapely
+from scipy import sparse
+
+from grids import fix_coordinates, grid_hash, EARTH_RADIUS
+from regrid import cell_edges
+from cache import default_cache_dir
+
+
+
+# Weight matrices already loaded, by key
+_weights_cache = {}
+
+
+
+def cell_areas(lats,lons):
+    '''
+    Area (km2) of the cells of a regular lat/lon grid, shaped (lat, lon).
+    '''
+    lat_edges = np.clip(cell_edges(lats),-90,90)
+    lon_edges = cell_edges(lons)
+
+    dsin = np.abs(np.diff(np.sin(np.deg2rad(lat_edges))))
+    dlon = np.abs(np.diff(np.deg2rad(lon_edges)))
+
+    return EARTH_RADIUS**2*np.outer(dsin,dlon)
+
+
+
+def _regions_hash(regions):
+
+    h = hashlib.sha1()
+    h.update(str(regions.crs).encode())
+    h.update(repr(list(regions.index)).encode())
+    for wkb in shapely.to_wkb(np.asarray(regions.geometry.values)):
+        h.update(wkb)
+
+    return h.hexdigest()
+
+
+
+def zonal_weights(regions,grid,cache_dir=None):
+    '''
+    Returns the fraction of each grid cell covered by each region, as a sparse
+    (regions x grid cells) matrix, computed once per pair of regions and grid
+    and cached on disk.
+
+            Parameters:
+                    regions (geopandas.GeoDataFrame): Region polygons, e.g. catchments or provinces
+                    grid (xarray.Dataset or xarray.DataArray): Dataset on a regular lat/lon grid
+                    cache_dir (str): Cache directory (cache.default_cache_dir if None)
+
+            Returns:
+                    weights (scipy.sparse.csr_matrix): Cells in C order of the (latitude, longitude) dims
+    '''
+    ds = fix_coordinates(grid)
+
+    lats = ds['latitude']
+    lons = ds['longitude']
+    if lats.ndim != 1 or lons.ndim != 1:
+        raise ValueError('Zonal statistics need 1-D latitude and longitude')
+
+    if regions.crs is not None and not regions.crs.equals('EPSG:4326'):
+        regions = regions.to_crs('EPSG:4326')
+
+    key = hashlib.sha1(f'{grid_hash(ds)}|{_regions_hash(regions)}'.encode()).hexdigest()
+    if key in _weights_cache:
+        return _weights_cache[key]
+
+    cache_dir = os.path.join(default_cache_dir if cache_dir is None else cache_dir,'zonal')
+    path = os.path.join(cache_dir,f'{key}.npz')
+
+    if os.path.exists(path):
+        weights = sparse.load_npz(path).tocsr()
+
+    else:
+        lat_edges = cell_edges(lats.values)
+        lon_edges = cell_edges(lons.values)
+
+        # Cell boxes, in C order of (lat, lon)
+        LAT0, LON0 = np.meshgrid(lat_edges[:-1],lon_edges[:-1],indexing='ij')
+        LAT1, LON1 = np.meshgrid(lat_edges[1:],lon_edges[1:],indexing='ij')
+        boxes = shapely.box(np.minimum(LON0,LON1).ravel(),np.minimum(LAT0,LAT1).ravel(),
+                            np.maximum(LON0,LON1).ravel(),np.maximum(LAT0,LAT1).ravel())
+
+        geoms = np.asarray(regions.geometry.values)
+        tree = shapely.STRtree(boxes)
+        region, cell = tree.query(geoms,predicate='intersects')
+
+        overlap = shapely.area(shapely.intersection(geoms[region],boxes[cell]))
+        fraction = overlap/shapely.area(boxes[cell])
+        keep = fraction > 0
+
+        weights = sparse.csr_matrix((fraction[keep],(region[keep],cell[keep])),
+                                    shape=(len(regions),boxes.size))
+
+        os.makedirs(cache_dir,exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp.npz'
+        sparse.save_npz(tmp,weights)
+        os.replace(tmp,path)
+
+    _weights_cache[key] = weights
+
+    return weights
+
+
+
+def zonal_stats(dataarray,regions,stats=('mean','max','sum'),name=None,cache_dir=None):
+    '''
+    Zonal statistics of a field over a set of regions.
+
+    The regions are rasterized once into a sparse matrix of cell coverage
+    fractions; all the statistics of all the regions are then computed
+    together, reading each chunk of the data once.
+
+            Parameters:
+                    dataarray (xarray.DataArray): Field, e.g. precipitation or return period
+                    regions (geopandas.GeoDataFrame): Region polygons
+                    stats (tuple): Statistics among 'mean' (area-weighted mean),
+                                   'max' (maximum over the cells touched by the region)
+                                   and 'sum' (sum of the values weighted by the covered fraction)
+                    name (str): Column of regions used as region coordinate, the index if None
+                    cache_dir (str): Cache directory of the weights
+
+            Returns:
+                    ds (xarray.Dataset): One variable per statistic, with a 'region' dimension
+                                         (lazy if dataarray is dask-backed)
+    '''
+    stats = tuple(stats)
+    unknown = set(stats) - {'mean','max','sum'}
+    if unknown:
+        raise ValueError(f'Unknown statistics: {sorted(unknown)}')
+
+    da = fix_coordinates(dataarray)
+
+    fraction = zonal_weights(regions,da,cache_dir=cache_dir)
+    area = fraction.multiply(cell_areas(da['latitude'].values,da['longitude'].values).ravel()).tocsr()
+
+    spatial_dims = [da['latitude'].dims[0],da['longitude'].dims[0]]
+    nregions = fraction.shape[0]
+
+    starts = fraction.indptr[:-1]
+    touched = np.diff(fraction.indptr) > 0
+
+    def _stats(x):
+        lead = x.shape[:-2]
+        flat = x.reshape(-1,x.shape[-2]*x.shape[-1])
+
+        valid = ~np.isnan(flat)
+        filled = np.where(valid,flat,0)
+
+        out = []
+        for s in stats:
+            if s == 'mean':
+                num = area.dot(filled.T).T
+                den = area.dot(valid.T.astype(float)).T
+                with np.errstate(invalid='ignore',divide='ignore'):
+                    res = np.where(den > 0,num/den,np.nan)
+            elif s == 'sum':
+                res = fraction.dot(filled.T).T
+            else:
+                res = np.full((flat.shape[0],nregions),np.nan)
+                if touched.any():
+                    values = flat[:,fraction.indices]
+                    res[:,touched] = np.fmax.reduceat(values,starts[touched],axis=1)
+            out.append(res.reshape(lead+(nregions,)))
+
+        return tuple(out) if len(out) > 1 else out[0]
+
+    if da.chunks is not None:
+        da = da.chunk({d : -1 for d in spatial_dims})
+
+    results = xr.apply_ufunc(_stats,da,
+                             input_core_dims=[spatial_dims],
+                             output_core_dims=[['region']]*len(stats),
+                             dask='parallelized',
+                             output_dtypes=[float]*len(stats),
+                             dask_gufunc_kwargs={'output_sizes' : {'region' : nregions}})
+    if len(stats) == 1:
+        results = (results,)
+
+    region = regions.index.values if name is None else regions[name].values
+
+    ds = xr.Dataset({s : r for s, r in zip(stats,results)})
+    ds = ds.assign_coords(region=region)
+    ds.attrs.update(da.attrs)
+
+    return ds